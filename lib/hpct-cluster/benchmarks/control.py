@@ -0,0 +1,291 @@
+#! /usr/bin/env python3
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+#
+# benchmarks/control.py
+
+"""Benchmark Control methods against a fake juju.
+
+juju (JUJU_EXEC), charms-builder and the hpctmanagers DistroManager are
+replaced by local stubs: the stub executables sleep for a configurable
+latency and answer with canned JSON sized to the cluster. Each
+(method, size) is run in a fresh process, which reports the number of
+subprocesses it ran, wall time and peak RSS. No LXD or controller is
+needed.
+
+usage: control.py [-l <latency>] [-m <method>[,...]] [<ncompute>:<nusers> ...]
+"""
+
+import json
+import os
+import os.path
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+LIB_DIR = os.path.abspath(f"{os.path.dirname(__file__)}/..")
+TOP_DIR = os.path.abspath(f"{LIB_DIR}/../..")
+sys.path.insert(0, LIB_DIR)
+
+METHODS = ["info", "generate", "deploy", "cleanup"]
+SIZES = [(1, 10), (10, 100), (100, 1000), (1000, 10000)]
+PROFILE_NAME = "bench"
+
+# stub executables: log each call, sleep, answer from the state file
+_STUB_JUJU = """#! %(python)s
+import fcntl, json, os, sys, time
+
+with open(os.environ["HPCT_BENCH_LOG"], "a") as f:
+    f.write("juju " + " ".join(sys.argv[1:]) + "\\n")
+time.sleep(float(os.environ.get("HPCT_BENCH_LATENCY", "0")))
+
+cmd = sys.argv[1] if len(sys.argv) > 1 else ""
+with open(os.environ["HPCT_BENCH_STATE"], "r+") as f:
+    fcntl.flock(f, fcntl.LOCK_EX)
+    state = json.load(f)
+    if cmd == "status":
+        print(json.dumps(state["status"]))
+    elif cmd == "controllers":
+        print(json.dumps({"controllers": {"default": {}}, "current-controller": "default"}))
+    elif cmd == "users":
+        print(json.dumps([{"user-name": "admin"}, {"user-name": "clusteradmin"}]))
+    elif cmd == "whoami":
+        print(json.dumps({"controller": "default", "model": "admin/bench", "user": "clusteradmin"}))
+    elif cmd == "remove-application":
+        state["status"]["applications"].pop(sys.argv[2], None)
+        f.seek(0)
+        f.truncate()
+        json.dump(state, f)
+"""
+
+_STUB_CHARMS_BUILDER = """#! %(python)s
+import os, sys, time
+
+with open(os.environ["HPCT_BENCH_LOG"], "a") as f:
+    f.write("charms-builder " + " ".join(sys.argv[1:]) + "\\n")
+time.sleep(float(os.environ.get("HPCT_BENCH_LATENCY", "0")))
+if sys.argv[1] == "list":
+    print("\\n".join(%(charms)r))
+"""
+
+
+class StubManager:
+    """Stand-in for hpctmanagers managers."""
+
+    def __init__(self, install_packages=None, install_snaps=None, **kwargs):
+        self.install_packages = install_packages or getattr(self, "install_packages", [])
+        self.install_snaps = install_snaps or []
+
+    def __getattr__(self, name):
+        if name.startswith("is_"):
+            return lambda: True
+        return lambda *args, **kwargs: None
+
+
+def install_stub_managers():
+    """Register stub hpctmanagers modules."""
+
+    pkg = types.ModuleType("hpctmanagers")
+    pkg.ManagerException = Exception
+    pkg.get_series = lambda: types.SimpleNamespace(full="ubuntu-22.04")
+    sys.modules["hpctmanagers"] = pkg
+    for name in ["redhat", "ubuntu"]:
+        mod = types.ModuleType(f"hpctmanagers.{name}")
+        mod.RedHatManager = mod.UbuntuManager = StubManager
+        sys.modules[f"hpctmanagers.{name}"] = mod
+
+
+def make_status(ncompute):
+    from hpctcluster.bundle import BUNDLE_APPNAMES
+
+    def unit():
+        return {"workload-status": {"current": "active"}, "juju-status": {"current": "idle"}}
+
+    applications = {appname: {"units": {}} for appname in BUNDLE_APPNAMES}
+    applications["compute-node"]["units"] = {f"compute-node/{i}": unit() for i in range(ncompute)}
+    for appname in ["head-node", "interactive-node", "ldap-node", "nfs-node", "slurm-node"]:
+        applications[appname]["units"] = {f"{appname}/0": unit()}
+    machines = {str(i): {"juju-status": {"current": "started"}} for i in range(ncompute + 5)}
+    return {"applications": applications, "machines": machines}
+
+
+def make_interview_results(ncompute, nusers):
+    return {
+        "nodes": {"ncompute": ncompute, "nhead": 1, "ninteractive": 1, "nldap": 1, "nslurm": 1},
+        "user": {
+            "count": nusers,
+            "name": {str(i): f"user{i}" for i in range(nusers)},
+            "group": {str(i): f"group{i % 10}" for i in range(nusers)},
+        },
+    }
+
+
+def setup_tree(bench_dir, ncompute, nusers):
+    """Create top dir with working profile, stubs and state."""
+
+    import yaml
+
+    from hpctcluster.charms import load_charms_config
+
+    work_profile_dir = f"{bench_dir}/work/{PROFILE_NAME}"
+    shutil.copytree(f"{TOP_DIR}/etc/hpct-cluster/profiles/edge", work_profile_dir)
+    with open(f"{work_profile_dir}/interview-out.yaml", "w") as f:
+        yaml.safe_dump(make_interview_results(ncompute, nusers), f)
+
+    charms = sorted(load_charms_config(f"{work_profile_dir}/charms-builder/charms-builder.yaml"))
+    stubs = [
+        (f"{bench_dir}/bin/juju", _STUB_JUJU),
+        (f"{bench_dir}/vendor/hpct-charms-builder/bin/charms-builder", _STUB_CHARMS_BUILDER),
+    ]
+    for path, template in stubs:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(template % {"python": sys.executable, "charms": charms})
+        os.chmod(path, 0o755)
+
+    with open(f"{bench_dir}/state.json", "w") as f:
+        json.dump({"status": make_status(ncompute)}, f)
+
+    # local juju client files (see Juju.controller_readiness())
+    os.makedirs(f"{bench_dir}/juju-data")
+    for name in ["accounts", "controllers"]:
+        with open(f"{bench_dir}/juju-data/{name}.yaml", "w") as f:
+            yaml.safe_dump({"controllers": {"default": {"user": "clusteradmin"}}}, f)
+    open(f"{bench_dir}/calls.log", "w").close()
+
+
+def run_one(method, bench_dir):
+    """Run one method (in this process) and print results as JSON."""
+
+    import importlib.util
+
+    install_stub_managers()
+
+    import hpctcluster.juju
+
+    juju_exec = f"{bench_dir}/bin/juju"
+    hpctcluster.juju.JUJU_EXEC = juju_exec
+    # removal is polled; keep the poll interval out of the measurement
+    hpctcluster.juju.REMOVE_WAIT_INTERVAL = 0.01
+
+    spec = importlib.util.spec_from_file_location("hpct_cluster", f"{LIB_DIR}/hpct-cluster.py")
+    hc = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(hc)
+    hc.JUJU_EXEC = juju_exec
+    hc.top_dir = bench_dir
+    hc.etc_dir = f"{TOP_DIR}/etc/hpct-cluster"
+    hc.vendordir = f"{bench_dir}/vendor"
+
+    nsubprocesses = [0]
+    subprocess_run = subprocess.run
+
+    def counting_run(*args, **kwargs):
+        nsubprocesses[0] += 1
+        return subprocess_run(*args, **kwargs)
+
+    subprocess.run = counting_run
+
+    control = hc.Control(PROFILE_NAME)
+    control.load_interview_results()
+    if method in ["deploy", "cleanup"]:
+        with open(os.devnull, "w") as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            control.generate()
+            sys.stdout = stdout
+    nsubprocesses[0] = 0
+
+    with open(os.devnull, "w") as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        start_time = time.perf_counter()
+        try:
+            getattr(control, method)()
+            error = None
+        except Exception as e:
+            error = str(e)
+        wall = time.perf_counter() - start_time
+        sys.stdout = stdout
+
+    print(
+        json.dumps(
+            {
+                "wall": wall,
+                "subprocesses": nsubprocesses[0],
+                "maxrss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                "error": error,
+            }
+        )
+    )
+
+
+def run_method(method, ncompute, nusers, latency):
+    bench_dir = tempfile.mkdtemp(prefix="hpct-bench-")
+    try:
+        setup_tree(bench_dir, ncompute, nusers)
+        env = dict(os.environ)
+        env.update(
+            {
+                "HPCT_BENCH_LOG": f"{bench_dir}/calls.log",
+                "HPCT_BENCH_STATE": f"{bench_dir}/state.json",
+                "HPCT_BENCH_LATENCY": str(latency),
+                "JUJU_DATA": f"{bench_dir}/juju-data",
+                "LOGNAME": env.get("LOGNAME", "bench"),
+            }
+        )
+        cp = subprocess.run(
+            [sys.executable, __file__, "--one", method, bench_dir],
+            env=env,
+            capture_output=True,
+            text=True,
+        )
+        if cp.returncode != 0:
+            return {"error": (cp.stderr.strip().splitlines() or ["failed"])[-1]}
+        result = json.loads(cp.stdout.strip().splitlines()[-1])
+        result["calls"] = len(open(f"{bench_dir}/calls.log").readlines())
+        return result
+    finally:
+        shutil.rmtree(bench_dir, ignore_errors=True)
+
+
+def main():
+    args = sys.argv[1:]
+    if args[:1] == ["--one"]:
+        run_one(args[1], args[2])
+        return
+
+    latency = 0.0
+    methods = METHODS
+    sizes = []
+    while args:
+        arg = args.pop(0)
+        if arg == "-l":
+            latency = float(args.pop(0))
+        elif arg == "-m":
+            methods = args.pop(0).split(",")
+        else:
+            ncompute, nusers = arg.split(":")
+            sizes.append((int(ncompute), int(nusers)))
+    sizes = sizes or SIZES
+
+    print(
+        f"""{"method":10} {"compute":>8} {"users":>8} {"procs":>6} {"stub":>6}"""
+        f""" {"wall":>9} {"maxrss":>9}"""
+    )
+    for method in methods:
+        for ncompute, nusers in sizes:
+            r = run_method(method, ncompute, nusers, latency)
+            if r.get("error") and "wall" not in r:
+                print(f"{method:10} {ncompute:>8} {nusers:>8} error: {r['error']}")
+                continue
+            print(
+                f"{method:10} {ncompute:>8} {nusers:>8} {r['subprocesses']:>6} {r['calls']:>6}"
+                f" {r['wall'] * 1000:7.1f}ms {r['maxrss'] / 1024:7.1f}MB"
+                + (f"  (error: {r['error']})" if r["error"] else "")
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+#! /usr/bin/env python3
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+#
+# benchmarks/dotteddict.py
+
+"""Micro-benchmark DottedDictWrapper against CompiledDottedDictWrapper.
+
+usage: dotteddict.py [<nusers> ...]
+"""
+
+import os.path
+import sys
+import timeit
+
+sys.path.insert(0, os.path.abspath(f"{os.path.dirname(__file__)}/.."))
+
+from hpctcluster.lib import CompiledDottedDictWrapper, DottedDictWrapper
+
+
+def make_config(nusers):
+    """Interview-like results with parameterized user keys."""
+
+    return {
+        "charm_home": "/charms",
+        "nodes": {"ncompute": 4, "nhead": 1, "ninteractive": 1, "nldap": 1, "nslurm": 1},
+        "user": {
+            "count": nusers,
+            "name": {str(i): f"user{i}" for i in range(nusers)},
+            "group": {str(i): f"group{i % 10}" for i in range(nusers)},
+        },
+    }
+
+
+def bench(cls, nusers, number):
+    dd = cls(make_config(nusers), ".")
+    keys = [f"user.name.{i}" for i in range(0, nusers, max(1, nusers // 100))]
+
+    def getitem():
+        for key in keys:
+            dd[key]
+
+    def get():
+        for key in keys:
+            dd.get(key)
+        dd.get("nodes.nmissing", 0)
+
+    def items():
+        for _ in dd.items():
+            pass
+
+    return {
+        "getitem": timeit.timeit(getitem, number=number) / number,
+        "get": timeit.timeit(get, number=number) / number,
+        "items": timeit.timeit(items, number=max(1, number // 100)) / max(1, number // 100),
+    }
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10, 1000, 10000]
+
+    print(f"""{"users":>8} {"op":8} {"DottedDict":>12} {"Compiled":>12} {"speedup":>8}""")
+    for nusers in sizes:
+        base = bench(DottedDictWrapper, nusers, 1000)
+        compiled = bench(CompiledDottedDictWrapper, nusers, 1000)
+        for op in base:
+            print(
+                f"{nusers:>8} {op:8} {base[op] * 1e6:10.1f}us {compiled[op] * 1e6:10.1f}us"
+                f" {base[op] / compiled[op]:7.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+#! /usr/bin/env python3
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+#
+# benchmarks/startup.py
+
+"""Benchmark hpct-cluster startup.
+
+Runs quick commands (help, show-interview-results, generate) as fresh
+processes, as a user would, from a temporary top dir with a working
+profile and stub hpctmanagers. Reports min and median wall time per
+command, and exits non-zero if a median is over the limit (-t, in ms).
+
+usage: startup.py [-n <runs>] [-t <max-ms>] [-c <command>[,...]]
+"""
+
+import os
+import os.path
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+LIB_DIR = os.path.abspath(f"{os.path.dirname(__file__)}/..")
+TOP_DIR = os.path.abspath(f"{LIB_DIR}/../..")
+sys.path.insert(0, LIB_DIR)
+
+PROFILE_NAME = "bench"
+COMMANDS = {
+    "help": ["-h"],
+    "show-interview-results": ["show-interview-results", "-p", PROFILE_NAME],
+    "generate": ["generate", "-p", PROFILE_NAME],
+}
+RUNS = 10
+MAX_MS = 100
+
+_STUB_HPCTMANAGERS = """
+class ManagerException(Exception):
+    pass
+
+
+class _Series:
+    full = "ubuntu-22.04"
+
+
+def get_series():
+    return _Series()
+"""
+
+_STUB_MANAGER = """
+class %(name)s:
+    def __init__(self, **kwargs):
+        pass
+
+    def set_verbose(self, verbose):
+        pass
+"""
+
+
+def setup_tree(bench_dir):
+    """Create top dir with bin/hpct-cluster, working profile and stub
+    hpctmanagers."""
+
+    import yaml
+
+    os.makedirs(f"{bench_dir}/bin")
+    os.symlink(f"{LIB_DIR}/hpct-cluster.py", f"{bench_dir}/bin/hpct-cluster")
+    os.makedirs(f"{bench_dir}/etc")
+    os.symlink(f"{TOP_DIR}/etc/hpct-cluster", f"{bench_dir}/etc/hpct-cluster")
+
+    work_profile_dir = f"{bench_dir}/work/{PROFILE_NAME}"
+    shutil.copytree(f"{TOP_DIR}/etc/hpct-cluster/profiles/edge", work_profile_dir)
+    with open(f"{work_profile_dir}/interview-out.yaml", "w") as f:
+        yaml.safe_dump(
+            {
+                "nodes": {"ncompute": 4, "nhead": 1, "ninteractive": 1, "nldap": 1, "nslurm": 1},
+                "user": {"count": 1, "name": {"0": "user0"}, "group": {"0": "group0"}},
+            },
+            f,
+        )
+
+    pkg_dir = f"{bench_dir}/vendor/hpct-managers/lib/hpctmanagers"
+    os.makedirs(pkg_dir)
+    with open(f"{pkg_dir}/__init__.py", "w") as f:
+        f.write(_STUB_HPCTMANAGERS)
+    for modname, name in [("redhat", "RedHatManager"), ("ubuntu", "UbuntuManager")]:
+        with open(f"{pkg_dir}/{modname}.py", "w") as f:
+            f.write(_STUB_MANAGER % {"name": name})
+
+
+def time_command(bench_dir, args, runs):
+    """Return list of wall times (s) of runs of hpct-cluster args."""
+
+    env = dict(os.environ)
+    env["LOGNAME"] = env.get("LOGNAME", "bench")
+    times = []
+    for _ in range(runs):
+        start_time = time.perf_counter()
+        cp = subprocess.run(
+            [sys.executable, "./hpct-cluster", *args],
+            cwd=f"{bench_dir}/bin",
+            env=env,
+            capture_output=True,
+            text=True,
+        )
+        times.append(time.perf_counter() - start_time)
+        if cp.returncode != 0:
+            raise Exception((cp.stderr.strip().splitlines() or ["failed"])[-1])
+    return times
+
+
+def main():
+    args = sys.argv[1:]
+    runs = RUNS
+    max_ms = MAX_MS
+    names = list(COMMANDS)
+    while args:
+        arg = args.pop(0)
+        if arg == "-n":
+            runs = int(args.pop(0))
+        elif arg == "-t":
+            max_ms = float(args.pop(0))
+        elif arg == "-c":
+            names = args.pop(0).split(",")
+        else:
+            print(f"error: unknown argument ({arg})", file=sys.stderr)
+            sys.exit(1)
+
+    bench_dir = tempfile.mkdtemp(prefix="hpct-startup-")
+    failed = False
+    try:
+        setup_tree(bench_dir)
+        print(f"""{"command":24} {"min":>9} {"median":>9}""")
+        for name in names:
+            try:
+                times = time_command(bench_dir, COMMANDS[name], runs)
+            except Exception as e:
+                print(f"{name:24} error: {e}")
+                failed = True
+                continue
+            median = statistics.median(times) * 1000
+            over = median > max_ms
+            failed = failed or over
+            print(
+                f"{name:24} {min(times) * 1000:7.1f}ms {median:7.1f}ms"
+                + (f"  (over {max_ms:.0f}ms)" if over else "")
+            )
+    finally:
+        shutil.rmtree(bench_dir, ignore_errors=True)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -18,25 +18,19 @@ if sys.version_info.minor < 8:
         sys.exit(1)
 
 
+import functools
 import os
 import os.path
-import shutil
 import signal
 import subprocess
 import sys
-import yaml
 
 sys.path.insert(0, "../vendor/hpct-managers/lib")
 
-from hpctcluster.bundle import BUNDLE_APPNAMES, generate_bundle
-from hpctcluster.juju import Juju
-from hpctcluster.lib import run, run_capture
-from hpctcluster.managers.snapd import SnapdManager
-
-if os.path.exists("/etc/redhat-release"):
-    from hpctmanagers.redhat import RedHatManager as DistroManager
-else:
-    from hpctmanagers.ubuntu import UbuntuManager as DistroManager
+# other modules are imported where needed, to keep startup fast
+from hpctcluster.lib import get_git_commit, run, run_capture
+from hpctcluster.probes import PROBE_TTLS, ProbeCache
+from hpctcluster.trace import phase
 
 
 JUJU_EXEC = "/snap/bin/juju"
@@ -51,10 +45,25 @@ TERMINALS = [
 ]
 
 
+def get_manager(**kwargs):
+    """Return (verbose) distro manager."""
+
+    if os.path.exists("/etc/redhat-release"):
+        from hpctmanagers.redhat import RedHatManager as DistroManager
+    else:
+        from hpctmanagers.ubuntu import UbuntuManager as DistroManager
+
+    manager = DistroManager(**kwargs)
+    manager.set_verbose(True)
+    return manager
+
+
 class Control:
-    def __init__(self, profile_name):
+    def __init__(self, profile_name, fresh=False):
         global top_dir, etc_dir
 
+        import yaml
+
         self.profile_name = profile_name
         self.profile_path = os.path.abspath(f"{top_dir}/work/{profile_name}/main.yaml")
 
@@ -62,6 +71,7 @@ class Control:
             # dirs
             self.work_dir = f"{top_dir}/work"
             self.work_profile_dir = f"{self.work_dir}/{profile_name}"
+            self.setup_markers_dir = f"{self.work_profile_dir}/setup"
 
             # profiles
             self.profile = yaml.safe_load(open(self.profile_path).read())
@@ -72,58 +82,93 @@ class Control:
             self.charms_dir = f"{self.work_profile_dir}/charms"
             self.build_config_path = f"{self.work_profile_dir}/charms-builder/charms-builder.yaml"
             self.bundle_path = f"{self.work_profile_dir}/bundle.yaml"
+            self.deployed_path = f"{self.work_profile_dir}/deployed.yaml"
             self.charms_builder_exec = f"{vendordir}/hpct-charms-builder/bin/charms-builder"
+            self.build_logs_dir = f"{self.work_profile_dir}/logs/build"
+            self.charms_manifest_path = f"{self.work_profile_dir}/charms-manifest.json"
+            self.charms_cache_dir = os.environ.get("HPCT_CHARMS_CACHE") or self.profile[
+                "charm"
+            ].get("cache-dir")
+            if self.charms_cache_dir:
+                self.charms_cache_dir = self._resolve_path(self.charms_cache_dir, self.work_dir)
 
             # interview
             self.interview_config_path = f"{self.work_profile_dir}/interview/interview.yaml"
             self.interview_out_path = f"{self.work_profile_dir}/interview-out.yaml"
-            self.interview_results = {}
+            self._interview_results = None
 
-            # juju
-            self.juju = Juju(
+            # users
+            self.users_import_state_path = f"{self.work_profile_dir}/users-import.json"
+
+            # juju (see juju property)
+            self.juju_args = (
                 self.juju_profile["cloud"],
                 self.juju_profile["controller"],
                 self.juju_profile["model"],
             )
+            self.juju_backend = (
+                os.environ.get("HPCT_JUJU_BACKEND") or self.juju_profile.get("backend")
+            )
+            # readiness probe deadline (seconds)
+            self.juju_ready_timeout = self.juju_profile.get("ready-timeout")
+            if self.juju_ready_timeout != None:
+                self.juju_ready_timeout = float(self.juju_ready_timeout)
             self.juju_user = self.juju_profile["user"]
+            self.juju_user_password_path = f"{self.work_profile_dir}/juju-user-password"
+
+            # probe results (cached across invocations)
+            self.probes = ProbeCache(f"{self.work_profile_dir}/probe-cache.json", fresh)
         except Exception as e:
             print(f"error: profile not complete ({e})", file=sys.stderr)
             sys.exit(1)
 
         # other
         self.username = os.environ["LOGNAME"]
+        # juju login may prompt (not from fleet workers)
+        self.login_prompt = True
 
-        # managers
-        self.charmcraft_manager = DistroManager(
-            install_snaps=[
-                {"name": "charmcraft", "args": ["--classic"]},
-            ]
-        )
-        self.charmcraft_manager.set_verbose(True)
+    # managers and juju are set up on first use
+    @functools.cached_property
+    def charmcraft_manager(self):
+        return get_manager(install_snaps=[{"name": "charmcraft", "args": ["--classic"]}])
 
-        self.juju_manager = DistroManager(
-            install_snaps=[
-                {"name": "juju", "args": ["--classic"]},
-            ]
-        )
-        self.juju_manager.set_verbose(True)
+    @functools.cached_property
+    def juju(self):
+        from hpctcluster.juju import Juju
 
-        self.lxd_manager = DistroManager(
-            install_snaps=[
-                {"name": "lxd", "channel": "latest"},
-            ]
+        return Juju(
+            *self.juju_args, backend=self.juju_backend, ready_timeout=self.juju_ready_timeout
         )
-        self.lxd_manager.set_verbose(True)
 
-        self.other_manager = DistroManager(
-            install_packages=["terminator"],
-        )
-        self.other_manager.set_verbose(True)
+    @functools.cached_property
+    def juju_manager(self):
+        return get_manager(install_snaps=[{"name": "juju", "args": ["--classic"]}])
+
+    @functools.cached_property
+    def lxd_manager(self):
+        return get_manager(install_snaps=[{"name": "lxd", "channel": "latest"}])
+
+    @functools.cached_property
+    def other_manager(self):
+        return get_manager(install_packages=["terminator"])
+
+    @functools.cached_property
+    def snapd_manager(self):
+        from hpctcluster.managers.snapd import SnapdManager
+
+        manager = SnapdManager()
+        manager.set_verbose(True)
+        return manager
 
-        self.snapd_manager = SnapdManager()
-        self.snapd_manager.set_verbose(True)
+    @property
+    def interview_results(self):
+        if self._interview_results == None:
+            self.load_interview_results()
+        return self._interview_results
 
     def _info_general(self):
+        from hpctcluster.charms import CharmInventory
+
         print("GENERAL:")
         print(f"profile: {self.profile_name}")
         print(f"user: {self.username}")
@@ -138,23 +183,31 @@ class Control:
 
         print()
         print("SNAPD:")
-        print(f"snapd installed: {self.snapd_manager.is_installed()}")
+        snapd_installed = self._probe("snapd.installed", self.snapd_manager.is_installed)
+        print(f"snapd installed: {snapd_installed}")
 
         print()
         print("CHARMCRAFT:")
-        print(f"charmcraft installed: {self.charmcraft_manager.is_installed()}")
+        charmcraft_installed = self._probe(
+            "charmcraft.installed", self.charmcraft_manager.is_installed
+        )
+        print(f"charmcraft installed: {charmcraft_installed}")
 
         print()
         print("LXD:")
-        print(f"lxd installed: {self.lxd_manager.is_installed()}")
+        print(f"""lxd installed: {self._probe("lxd.installed", self.lxd_manager.is_installed)}""")
         print(f"""lxd user: {self.lxd_profile["user"]}""")
-        print(f"user in lxd group: {self.is_user_in_lxd_group()}")
+        print(f"""user in lxd group: {self._probe("lxd.group", self.is_user_in_lxd_group)}""")
+        if self._get_image_targets():
+            images = self._probe("lxd.images", self._get_image_status)
+            print(f"""images: {" ".join([f"{k} ({v})" for k, v in images.items()])}""")
 
         print()
         print("OTHER PACKAGES:")
         print(f"""native packages: {" ".join(self.other_manager.install_packages)}""")
         print(f"""snap packages: {" ".join(self.other_manager.install_snaps)}""")
-        print(f"packages installed: {self.other_manager.is_installed()}")
+        other_installed = self._probe("other.installed", self.other_manager.is_installed)
+        print(f"packages installed: {other_installed}")
 
         print()
         print("INTERVIEW:")
@@ -167,50 +220,49 @@ class Control:
 
         print()
         print("CHARMS:")
-        cp = run_capture(
-            [
-                self.charms_builder_exec,
-                "list-built",
-                "-c",
-                self.build_config_path,
-                "-C",
-                self.charms_dir,
-            ],
-            text=True,
-        )
-        built_charms = list(filter(None, cp.stdout.split("\n"))) if cp.returncode == 0 else []
-
-        cp = run_capture(
-            [
-                self.charms_builder_exec,
-                "list-missing",
-                "-c",
-                self.build_config_path,
-                "-C",
-                self.charms_dir,
-            ],
-            text=True,
+        inventory = CharmInventory(
+            self.build_config_path,
+            self.charms_dir,
+            self.profile["charm"]["run-on"],
+            self.charms_manifest_path,
         )
-        missing_charms = list(filter(None, cp.stdout.split("\n"))) if cp.returncode == 0 else []
+        records = inventory.get()
+        # a hit only if built for the current key (source commit, ...)
+        cached = [charm for charm, record in records.items() if record["cached"]]
+        keys = self._get_charm_keys(cached) if cached else {}
+        for charm, record in records.items():
+            key_hash = keys[charm][1] if charm in keys else None
+            if record["cached"] and key_hash == record["hash"]:
+                print(f"""{charm}: cache hit ({record["hash"][:12]})""")
+            elif record["cached"] and key_hash != None:
+                print(f"{charm}: stale (source changed)")
+            elif record["cached"]:
+                print(f"{charm}: built (source commit unknown)")
+            elif record["built"]:
+                print(f"{charm}: ready (not cached)")
+            else:
+                print(f"{charm}: cache miss")
 
-        all_charms = sorted(built_charms + missing_charms)
-        for charm in all_charms:
-            print(f"""{charm}: {"ready" if charm in built_charms else "missing"}""")
+    def _info_juju(self, juju_installed):
+        from hpctcluster.juju import JujuSnapshot
 
-    def _info_juju(self):
         print(f"JUJU:")
         print(f"""user: {self.juju_profile["user"]}""")
         print(f"""cloud: {self.juju_profile["cloud"]}""")
         print(f"""controller: {self.juju_profile["controller"]}""")
         print(f"""model: {self.juju_profile["model"]}""")
 
-        print(f"juju installed: {self.juju_manager.is_installed()}")
-        if self.juju_manager.is_installed():
-            print(f"bootstrapped: {self.juju.is_ready()}")
-            if self.juju.is_ready():
-                print(f"""user ready: {self.juju.is_user_ready(self.juju_profile["user"])}""")
-                print(f"""controller ready: {self.juju.is_controller_ready()}""")
-                print(f"""model ready: {self.juju.is_model_ready()}""")
+        print(f"juju installed: {juju_installed}")
+        if juju_installed:
+            snapshot = JujuSnapshot(
+                self.juju.controller,
+                **self._probe("juju.snapshot", lambda: self.juju.snapshot().as_dict()),
+            )
+            print(f"bootstrapped: {snapshot.is_ready()}")
+            print(f"controller state: {snapshot.controller_state}")
+            if snapshot.is_ready() and snapshot.is_controller_ready():
+                print(f"""user ready: {snapshot.is_user_ready(self.juju_profile["user"])}""")
+                print(f"model state: {snapshot.model_state}")
 
     def _info_profiles(self):
         print("PROFILES:")
@@ -219,6 +271,179 @@ class Control:
         print(f"""source: {" ".join(sorted(src_profile_names))}""")
         print(f"""working: {" ".join(sorted(work_profile_names))}""")
 
+    def _check_capacity(self, host, bundle, status):
+        """Report host capacity against what deploying bundle adds to
+        the model; return whether it fits."""
+
+        from hpctcluster.capacity import bundle_demand, check, model_usage, print_report
+
+        print("checking capacity ...")
+        usage = model_usage(status)
+        demand = bundle_demand(bundle, status)
+        print_report(host, usage, demand)
+        return not check(host, usage, demand)
+
+    def _downscale(self, host, bundle, status):
+        """Scale the compute nodes of bundle down to the most that fit,
+        save the bundle and return it (None if none fit). The rest of
+        the bundle (e.g., hand edits) is kept."""
+
+        from hpctcluster.bundle import print_bundle_stats, save_bundle, scale_application
+        from hpctcluster.capacity import bundle_demand, check, model_usage
+
+        usage = model_usage(status)
+        ncompute = bundle["applications"]["compute-node"]["num_units"]
+
+        # demand grows with the number of compute nodes
+        fits = None
+        low, high = 1, ncompute - 1
+        while low <= high:
+            n = (low + high) // 2
+            scaled = scale_application(bundle, "compute-node", n)
+            if check(host, usage, bundle_demand(scaled, status)):
+                high = n - 1
+            else:
+                fits = scaled
+                low = n + 1
+        if fits == None:
+            return None
+
+        n = fits["applications"]["compute-node"]["num_units"]
+        print(f"downscaling to {n} compute nodes (of {ncompute}) ...")
+        save_bundle(fits, self.bundle_path)
+        print_bundle_stats(fits)
+        print(f"(previous bundle kept as {self.bundle_path}.prev)")
+        return fits
+
+    def _get_bundle_charm_hashes(self, bundle):
+        """Get build hashes of bundle charms, by application."""
+
+        from hpctcluster.charms import CharmInventory
+
+        inventory = CharmInventory(
+            self.build_config_path,
+            self.charms_dir,
+            self.profile["charm"]["run-on"],
+            self.charms_manifest_path,
+        )
+        hashes = dict([(r["path"], r["hash"]) for r in inventory.get().values()])
+        return {
+            appname: hashes.get(app["charm"])
+            for appname, app in bundle.get("applications", {}).items()
+        }
+
+    def _get_bundle_config(self):
+        """Return interview results with the settings bundles are built
+        with."""
+
+        d = self.interview_results.copy()
+        d["charm_home"] = self.charms_dir
+        d["run-on"] = self.profile["charm"]["run-on"]
+        return d
+
+    def _get_charm_keys(self, charms, series=None):
+        """Get cache keys, looking up source commits concurrently."""
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        from hpctcluster.charms import (
+            CharmCache,
+            get_charmcraft_version,
+            get_source_commit,
+            load_charms_config,
+        )
+
+        charms_config = load_charms_config(self.build_config_path)
+        cache = CharmCache(self.charms_dir, self.profile["charm"]["run-on"])
+        charmcraft_version = get_charmcraft_version()
+
+        def get_key(charm):
+            d = charms_config.get(charm) or {}
+            commit = get_source_commit(d["repo"], d.get("branch")) if d.get("repo") else None
+            return charm, cache.make_key(charm, commit, charmcraft_version, series)
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            return dict(executor.map(get_key, charms))
+
+    def _get_host_capacity(self, config):
+        """Return host capacity for packing (from the profile, or LXD
+        on the localhost cloud), or None."""
+
+        from hpctcluster.bundle import is_packing, parse_constraints
+        from hpctcluster.lxd import get_host_capacity
+
+        if not is_packing(config):
+            return None
+        if self.lxd_profile.get("capacity"):
+            return parse_constraints(self.lxd_profile["capacity"])
+        if self.juju_profile["cloud"] in ["localhost", "lxd"]:
+            return get_host_capacity()
+        return None
+
+    def _get_host_resources(self):
+        """Return host cores, memory and storage pool free space for the
+        capacity check (LXD on the localhost cloud), or None."""
+
+        from hpctcluster.bundle import parse_constraints
+        from hpctcluster.lxd import get_host_capacity, get_storage_free
+
+        if self.juju_profile["cloud"] not in ["localhost", "lxd"]:
+            return None
+        if self.lxd_profile.get("capacity"):
+            host = parse_constraints(self.lxd_profile["capacity"])
+        else:
+            host = get_host_capacity()
+        if host == None:
+            return None
+        host["disk"] = get_storage_free(self.lxd_profile.get("storage-pool") or "default")
+        return host
+
+    def _get_image_status(self):
+        from hpctcluster.lxd import LxdImages
+
+        images = LxdImages()
+        return {
+            f"{series}/{arch}": images.status(series, arch)
+            for series, arch in self._get_image_targets()
+        }
+
+    def _get_image_targets(self):
+        """Return (series, arch) of the base images juju machines need
+        (only on the localhost/LXD cloud)."""
+
+        from hpctcluster.bundle import BUNDLE_SERIES
+        from hpctcluster.lxd import parse_run_on
+
+        if self.juju_profile["cloud"] not in ["localhost", "lxd"]:
+            return []
+        run_on = self.profile["charm"]["run-on"]
+        try:
+            series, arch = parse_run_on(run_on)
+        except Exception as e:
+            print(f"warning: no base images for run-on ({run_on}): {e}")
+            return []
+        return sorted(set([(series, arch), (BUNDLE_SERIES, arch)]))
+
+    def _prewarm_images(self):
+        """Make sure base images are cached locally (best effort)."""
+
+        from hpctcluster.lxd import LxdImages
+
+        images = LxdImages()
+        for series, arch in self._get_image_targets():
+            try:
+                rv = images.prewarm(series, arch)
+            except:
+                rv = 1
+            if rv != 0:
+                print(f"warning: cannot cache base image ({series}/{arch})")
+        self.probes.invalidate("lxd.images")
+
+    def _probe(self, name, fn):
+        """Return (cached) result of probe."""
+
+        return self.probes.get(name, fn, PROBE_TTLS[name.split(".")[-1]])
+
     def _resolve_path(self, path, basedir):
         """Resolve non-"/"-prefixed path."""
         if path.startswith("/"):
@@ -226,7 +451,9 @@ class Control:
         else:
             return f"{basedir}/{path}"
 
+    @phase("setup-charmcraft")
     def _setup_charmcraft(self):
+        self.probes.invalidate("charmcraft.")
         try:
             print("setting up charmcraft ...")
             self.charmcraft_manager.install()
@@ -237,11 +464,14 @@ class Control:
         except:
             raise
 
+    @phase("setup-cloud")
     def _setup_cloud(self):
         if os.path.exists("/etc/oracle-cloud-agent"):
             self._setup_oracle_cloud()
 
+    @phase("setup-juju")
     def _setup_juju(self):
+        self.probes.invalidate("juju.")
         try:
             print("setting up juju ...")
 
@@ -254,7 +484,9 @@ class Control:
                 print("juju is running")
             else:
                 print("running juju setup ...")
-                self.juju.setup()
+                if self.juju.setup() == 1:
+                    print("error: juju setup failed", file=sys.stderr)
+                    return 1
 
             if not self.juju_manager.is_running() or not self.juju.is_ready():
                 print("error: juju setup failed", file=sys.stderr)
@@ -264,12 +496,17 @@ class Control:
         except:
             raise
 
-    def _setup_juju_user(self):
+    @phase("setup-juju-user")
+    def _setup_juju_user(self, headless=False):
+        self.probes.invalidate("juju.")
         try:
             print(f"""setting up cluster admin user and rights in juju ...""")
 
             username = self.lxd_profile["user"]
 
+            if headless:
+                return self._setup_juju_user_headless(username)
+
             if self.juju.check_user(self.juju_user) == 0:
                 print("user already set up")
             else:
@@ -300,7 +537,60 @@ class Control:
         except:
             raise
 
+    def _setup_juju_user_headless(self, username):
+        """Register the juju user for the (OS) user without prompting.
+
+        The password is generated and kept, readable by the OS user
+        only, in the working profile directory. The password file is
+        only written once registration succeeds, and marks the user as
+        set up: an existing user's password is only reset (for a new
+        registration) when the file is missing."""
+
+        import pwd
+        import secrets
+
+        password_path = self.juju_user_password_path
+        exists = self.juju.check_user(self.juju_user) == 0
+        if exists and os.path.exists(password_path):
+            print("user already set up")
+            print("granting rights ...")
+            self.juju.grant(self.juju_user, "admin", self.juju_profile["model"])
+            print("juju user setup complete")
+            return
+
+        print("getting registration token ...")
+        token = self.juju.get_register_token(self.juju_user, reset=exists)
+        if token == None:
+            print("error: juju user setup failed (no registration token)", file=sys.stderr)
+            return 1
+
+        print("granting rights ...")
+        self.juju.grant(self.juju_user, "admin", self.juju_profile["model"])
+
+        password = secrets.token_urlsafe(24)
+        print(f"registering user ({self.juju_user}) for ({username}) ...")
+        d = self.juju.register_user(username, token, password)
+        if d.get("user") != self.juju_user or not d.get("model", "").endswith(
+            f"""/{self.juju_profile["model"]}"""
+        ):
+            print(f"error: juju user setup failed (whoami: {d})", file=sys.stderr)
+            return 1
+
+        # readable by the OS user, who needs it for "juju login"
+        pw = pwd.getpwnam(username)
+        tmp = f"{password_path}.tmp.{os.getpid()}"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wt") as f:
+            f.write(f"{password}\n")
+        os.chown(tmp, pw.pw_uid, pw.pw_gid)
+        os.replace(tmp, password_path)
+
+        print(f"juju user password: {password_path}")
+        print("juju user setup complete")
+
+    @phase("setup-lxd")
     def _setup_lxd(self):
+        self.probes.invalidate("lxd.")
         try:
             print("setting up lxd ...")
 
@@ -320,6 +610,30 @@ class Control:
         except:
             raise
 
+    @phase("setup-lxd-images")
+    def _setup_lxd_images(self):
+        from hpctcluster.lxd import LxdImages
+
+        self.probes.invalidate("lxd.images")
+        try:
+            print("setting up lxd images ...")
+
+            images = LxdImages()
+            bake = self.lxd_profile.get("images", {}).get("bake-packages")
+            for series, arch in self._get_image_targets():
+                if bake:
+                    rv = images.bake(series, arch, bake)
+                else:
+                    rv = images.prewarm(series, arch)
+                if rv != 0:
+                    print(f"error: lxd image ({series}/{arch}) setup failed", file=sys.stderr)
+                    return 1
+
+            print("lxd images setup complete")
+        except:
+            raise
+
+    @phase("setup-oracle-cloud")
     def _setup_oracle_cloud(self):
         try:
             print("setting up for oracle cloud ...")
@@ -340,7 +654,9 @@ class Control:
         except:
             raise
 
+    @phase("setup-other")
     def _setup_other(self):
+        self.probes.invalidate("other.")
         try:
             print("setting up other packages ...")
             self.other_manager.install()
@@ -351,7 +667,9 @@ class Control:
         except:
             raise
 
+    @phase("setup-snapd")
     def _setup_snapd(self):
+        self.probes.invalidate("snapd.")
         try:
             print("setting up snapd ...")
             self.snapd_manager.install()
@@ -370,59 +688,264 @@ class Control:
         except:
             raise
 
-    def build(self, series=None, charms=None):
+    @phase("build")
+    def build(self, series=None, charms=None, jobs=1, keep_going=False, use_cache=True):
+        from hpctcluster.build import BuildScheduler
+        from hpctcluster.charms import CharmCache
+
         if charms == None:
-            cp = run_capture([self.charms_builder_exec, "list", "-c", self.build_config_path])
+            cp = run_capture(
+                [self.charms_builder_exec, "list", "-c", self.build_config_path], text=True
+            )
             if cp.returncode != 0:
                 raise Exception("cannot get charms list")
             charms = cp.stdout.split()
         # charms = ["hpct-head-node-operator"]
 
-        cmdargs = [
+        # skip charms whose build key is unchanged (or restore them from
+        # the shared cache)
+        cache = CharmCache(self.charms_dir, self.profile["charm"]["run-on"], self.charms_cache_dir)
+        keys = self._get_charm_keys(charms, series)
+        if use_cache:
+            to_build = []
+            for charm in charms:
+                key, key_hash = keys[charm]
+                status = cache.lookup(charm, key_hash) if key_hash else None
+                if status:
+                    print(f"{charm}: cache {status} ({key_hash[:12]})")
+                else:
+                    to_build.append(charm)
+            cache.save()
+        else:
+            to_build = charms
+
+        if not to_build:
+            print("all charms up to date")
+            return
+
+        scheduler = BuildScheduler(
             self.charms_builder_exec,
-            "build",
-            "-c",
             self.build_config_path,
-            "-w",
             self.work_profile_dir,
-            "-C",
-            f"{self.charms_dir}",
-        ]
-        if series:
-            cmdargs.extend(["-s", series])
-        cmdargs.extend(charms)
+            self.charms_dir,
+            self.build_logs_dir,
+            series=series,
+            jobs=jobs,
+            keep_going=keep_going,
+        )
+        failed = scheduler.run(to_build)
+
+        for job in scheduler.build_jobs:
+            if job.state == "done":
+                cache.store(job.name, *keys[job.name])
+        cache.save()
+
+        if failed:
+            raise Exception(f"""charms not built ({" ".join([job.name for job in failed])})""")
+
+    @phase("cleanup")
+    def cleanup(self, force=False, jobs=4, timeout=None):
+        from hpctcluster.bundle import BUNDLE_APPNAMES, BUNDLE_SUBORDINATE_APPNAMES
+
+        self.probes.invalidate("juju.snapshot")
+        if self.juju.remove_applications(
+            BUNDLE_APPNAMES,
+            force=force,
+            subordinates=BUNDLE_SUBORDINATE_APPNAMES,
+            max_workers=jobs,
+            timeout=timeout,
+        ):
+            raise Exception("applications not removed")
+
+    @phase("deploy")
+    def deploy(
+        self,
+        wait=False,
+        timeout=None,
+        full=False,
+        dry_run=False,
+        downscale=False,
+        check_capacity=True,
+    ):
+        import yaml
+
+        from hpctcluster.bundle import active_appnames, plan_redeploy
+        from hpctcluster.juju import SNAPSHOT_TIMEOUT
+        from hpctcluster.watch import DeployTracker
+
+        bundle = yaml.safe_load(open(self.bundle_path).read())
+
+        status = None
+        host = self._get_host_resources() if check_capacity else None
+        if host != None or (not full and os.path.exists(self.deployed_path)):
+            status = self.juju.status(timeout=SNAPSHOT_TIMEOUT)
+            if status == None and host != None:
+                # without it, the machines already in the model are not counted
+                raise Exception(
+                    'cannot get model status for the capacity check ("--no-capacity-check"'
+                    " to deploy anyway)"
+                )
 
-        run(cmdargs, text=True, decorate=True)
+        # machines that do not fit stay pending; find out now
+        if host != None and not self._check_capacity(host, bundle, status):
+            if dry_run:
+                print("warning: not enough capacity")
+            elif not downscale:
+                raise Exception(
+                    'not enough capacity ("--downscale" to deploy fewer compute nodes,'
+                    ' "--no-capacity-check" to deploy anyway)'
+                )
+            else:
+                bundle = self._downscale(host, bundle, status)
+                if bundle == None:
+                    raise Exception("not enough capacity, even for one compute node")
+
+        hashes = self._get_bundle_charm_hashes(bundle)
+
+        # plan changes against the last deployed bundle and the live model
+        actions = None
+        if not full and os.path.exists(self.deployed_path):
+            deployed = yaml.safe_load(open(self.deployed_path).read())
+            if status != None:
+                actions = plan_redeploy(
+                    deployed["bundle"], bundle, status, deployed.get("charms", {}), hashes
+                )
 
-    def cleanup(self):
-        self.juju.remove_applications(BUNDLE_APPNAMES)
+        if not dry_run and (actions == None or [a for a in actions if a[0] == "add-unit"]):
+            # new machines start from local images
+            self._prewarm_images()
 
-    def deploy(self):
-        # deploy bundle
-        self.juju.deploy(f"{self.bundle_path}")
+        if actions == None:
+            print("deploying full bundle ...")
+            if dry_run:
+                return
+            if self.juju.deploy(f"{self.bundle_path}") != 0:
+                raise Exception("bundle not deployed")
+        elif not actions:
+            print("no changes to deploy")
+        else:
+            print(f"applying {len(actions)} changes ...")
+            for action in actions:
+                print(f"""{action[0]}: {" ".join([str(v) for v in action[1:]])}""")
+                if dry_run:
+                    continue
+                if action[0] == "add-unit":
+                    rv = self.juju.add_unit(action[1], action[2])
+                elif action[0] == "remove-unit":
+                    rv = self.juju.remove_unit(action[2])
+                elif action[0] == "refresh":
+                    rv = self.juju.refresh(action[1], action[2])
+                elif action[0] == "relate":
+                    rv = self.juju.relate(action[1], action[2])
+                elif action[0] == "remove-relation":
+                    rv = self.juju.remove_relation(action[1], action[2])
+                if rv != 0:
+                    raise Exception(f"failed to apply change ({action[0]} {action[1]})")
+
+        if dry_run:
+            return
+
+        self.probes.invalidate("juju.snapshot")
+        with open(self.deployed_path, "wt") as f:
+            yaml.safe_dump({"bundle": bundle, "charms": hashes}, f, default_flow_style=False)
+
+        if wait:
+            print("waiting for applications to become active ...")
+            # only applications that get units can become active
+            tracker = DeployTracker(active_appnames(bundle))
+            done = tracker.run(self.juju.watch(), timeout)
+            tracker.print_summary()
+            if not done:
+                raise Exception("timed out waiting for applications")
+
+    @phase("generate")
+    def generate(self, show=False):
+        from hpctcluster.bundle import generate_bundle
 
-    def generate(self):
         print("generating bundle ...")
-        if os.path.exists(self.bundle_path):
-            os.remove(self.bundle_path)
-        d = self.interview_results.copy()
-        d["charm_home"] = self.charms_dir
-        d["run-on"] = self.profile["charm"]["run-on"]
-        generate_bundle(self.interview_results, self.bundle_path)
+        d = self._get_bundle_config()
+        generate_bundle(d, self.bundle_path, self._get_host_capacity(d), show)
 
+    @phase("info")
     def info(self):
         self._info_general()
 
+        juju_installed = self._probe("juju.installed", self.juju_manager.is_installed)
         if self.username != "root":
-            if self.juju_manager.is_installed():
-                self.login()
+            if juju_installed:
+                try:
+                    self.login()
+                except Exception as e:
+                    print(f"warning: {e}")
 
         print()
-        self._info_juju()
+        self._info_juju(juju_installed)
+
+    @phase("import-users")
+    def import_users(self, path=None, batch_size=None, restart=False):
+        """Import users from CSV/LDIF file (or the interview results)
+        to the ldap server application, in batches."""
+
+        from hpctcluster.users import (
+            DEFAULT_ACTION,
+            DEFAULT_APPLICATION,
+            DEFAULT_BATCH_SIZE,
+            MAX_ERRORS_SHOWN,
+            UserImport,
+            load_users,
+            validate_users,
+        )
+
+        import_profile = (self.profile.get("users") or {}).get("import") or {}
+        application = import_profile.get("application") or DEFAULT_APPLICATION
+
+        print(f"""validating users ({path or "interview results"}) ...""")
+        try:
+            users, errors = validate_users(load_users(path, self.interview_results))
+        except Exception as e:
+            print(f"error: cannot read users ({e})", file=sys.stderr)
+            return 1
+        for location, error in errors[:MAX_ERRORS_SHOWN]:
+            print(f"{location}: {error}")
+        if errors:
+            print(f"error: {len(errors)} invalid users; nothing imported", file=sys.stderr)
+            return 1
+        if not users:
+            print("no users to import")
+            return
+
+        status = self.juju.status(timeout=30)
+        if status == None or application not in status.get("applications", {}):
+            print(f"error: application ({application}) not deployed", file=sys.stderr)
+            return 1
+
+        print(f"importing {len(users)} users to {application} ...")
+        user_import = UserImport(
+            self.juju,
+            self.users_import_state_path,
+            application,
+            import_profile.get("action") or DEFAULT_ACTION,
+            batch_size or import_profile.get("batch-size") or DEFAULT_BATCH_SIZE,
+        )
+        if user_import.run(users, restart):
+            return 1
+
+    @phase("interview")
+    def interview(self, answers_path=None, defaults=False):
+        if answers_path != None or defaults:
+            return self._interview_answers(answers_path)
 
-    def interview(self):
         # interview
         print("run interview ...")
+        if not sys.stdin.isatty():
+            # nobody to answer
+            if os.path.exists(self.interview_out_path):
+                print("no terminal; keeping existing results")
+                self.load_interview_results()
+                return
+            print('error: no terminal; use "--answers <file>" or "--defaults"', file=sys.stderr)
+            raise Exception("no terminal")
+
         if os.path.exists(self.interview_out_path):
             reply = input("Existing results found. Do you want to redo the interview (y/n)? ")
             if reply in ["n"]:
@@ -443,6 +966,36 @@ class Control:
 
         self.load_interview_results()
 
+    def _interview_answers(self, answers_path=None):
+        """Run interview in process with answers from file (defaults for
+        the rest) and write results."""
+
+        import yaml
+
+        from hpctcluster.interview import Interview
+
+        print(f"""run interview ({answers_path or "defaults"}) ...""")
+        answers = {}
+        if answers_path != None:
+            answers = yaml.safe_load(open(answers_path).read()) or {}
+
+        interview = Interview(self.interview_config_path, answers)
+        try:
+            results = interview.run()
+        except Exception as e:
+            print(f"error: {e}", file=sys.stderr)
+            raise
+        unused = interview.unused_answers()
+        if unused:
+            print(f"""warning: answers not used ({", ".join(unused)})""")
+
+        tmp = f"{self.interview_out_path}.tmp.{os.getpid()}"
+        with open(tmp, "wt") as f:
+            yaml.safe_dump(results, f, default_flow_style=False, sort_keys=False)
+        os.replace(tmp, self.interview_out_path)
+
+        self.load_interview_results()
+
     def is_user_in_lxd_group(self):
         cp = run_capture(["id", "-nG", self.lxd_profile["user"]], text=True)
         if cp.returncode == 0:
@@ -452,8 +1005,10 @@ class Control:
         return False
 
     def load_interview_results(self):
+        import yaml
+
         # defaults
-        control.interview_results = {
+        self._interview_results = {
             "charm_home": self.charms_dir,
             "nodes": {
                 "ncompute": 1,
@@ -467,17 +1022,28 @@ class Control:
         # update from interview
         if os.path.exists(self.interview_out_path):
             d = yaml.safe_load(open(self.interview_out_path).read())
-            self.interview_results.update(d)
+            self._interview_results.update(d)
 
+    @phase("login")
     def login(self):
-        d = self.juju.whoami()
-        juju_user = d.get("user", "")
+        # per controller: the current controller may be another
+        # profile's
+        juju_user = self._probe("juju.login", self.juju.account_user)
         # print(f"""logging in as user ({juju_user})""")
         if juju_user != self.juju_user:
+            self.probes.invalidate("juju.")
             self.juju.logout_user()
-            self.juju.login_user(self.juju_user)
+            if self.juju.login_user(self.juju_user, self.login_prompt) != 0:
+                raise Exception(f"cannot log in to juju as user ({self.juju_user})")
+
+    @phase("monitor")
+    def monitor(self, mode=None):
+        from hpctcluster.watch import StatusMonitor
+
+        if mode in ["plain", "tui"]:
+            StatusMonitor(self.juju, tui=(mode == "tui")).run()
+            return
 
-    def monitor(self):
         try:
             print("launching monitor ...")
 
@@ -490,7 +1056,7 @@ class Control:
                     print(f"found terminal program ({terminal})")
                     break
             else:
-                print("error: cannot find terminal", file=sys.stderr)
+                print("error: cannot find terminal (try --plain or --tui)", file=sys.stderr)
                 return 1
 
             try:
@@ -506,22 +1072,40 @@ class Control:
         except:
             raise
 
-    def prepare(self):
+    @phase("prepare")
+    def prepare(self, answers_path=None, defaults=False):
         self.info()
-        self.interview()
+        self.interview(answers_path, defaults)
         self.generate()
         self.build()
 
-    def setup(self):
-        if (
-            self._setup_other() == 1
-            or self._setup_snapd() == 1
-            or self._setup_lxd() == 1
-            or self._setup_cloud() == 1
-            or self._setup_juju() == 1
-            or self._setup_juju_user() == 1
-            or self._setup_charmcraft() == 1
-        ):
+    @phase("setup")
+    def setup(self, jobs=4, redo=False, headless=False):
+        from hpctcluster.pipeline import Pipeline, PipelineStep
+
+        # distro package manager steps ("snapd", "other") must not
+        # overlap (snapd goes first, to unblock the snap steps);
+        # juju-user prompts (unless headless) and so runs alone
+        steps = [
+            PipelineStep("snapd", self._setup_snapd, lock="packages"),
+            PipelineStep("other", self._setup_other, lock="packages"),
+            PipelineStep("lxd", self._setup_lxd, ["snapd"]),
+            PipelineStep("cloud", self._setup_cloud, ["lxd"]),
+            PipelineStep("lxd-images", self._setup_lxd_images, ["lxd"]),
+            PipelineStep("juju", self._setup_juju, ["snapd", "cloud"]),
+            PipelineStep(
+                "juju-user",
+                lambda: self._setup_juju_user(headless),
+                ["juju"],
+                interactive=not headless,
+            ),
+            PipelineStep("charmcraft", self._setup_charmcraft, ["snapd"]),
+        ]
+        pipeline = Pipeline(steps, self.setup_markers_dir, jobs, redo)
+        failed = pipeline.run()
+        pipeline.print_summary()
+
+        if failed:
             print("*** setup failed ***")
             return 1
 
@@ -545,41 +1129,207 @@ def main_build(control, args):
     try:
         charms = None
         series = None
+        jobs = 1
+        keep_going = False
+        use_cache = True
 
         while args:
             arg = args.pop(0)
-            if arg == "-s":
+            if arg == "-j":
+                jobs = int(args.pop(0))
+            elif arg in ["-k", "--keep-going"]:
+                keep_going = True
+            elif arg == "--no-cache":
+                use_cache = False
+            elif arg == "-s":
                 series = args.pop(0)
             else:
                 charms = [arg] + args
                 del args[:]
 
-        control.build(series, charms)
-    except:
-        print("error: build failed", file=sys.stderr)
+        control.build(series, charms, jobs, keep_going, use_cache)
+    except Exception as e:
+        print(f"error: build failed ({e})", file=sys.stderr)
         return 1
 
 
 def main_cleanup(control, args):
     try:
-        control.cleanup()
-    except:
-        print("error: cleanup failed", file=sys.stderr)
+        force = False
+        jobs = 4
+        timeout = None
+
+        while args:
+            arg = args.pop(0)
+            if arg == "--force":
+                force = True
+            elif arg == "-j":
+                jobs = int(args.pop(0))
+            elif arg == "-t":
+                timeout = float(args.pop(0))
+            else:
+                raise Exception(f"unknown option ({arg})")
+    except Exception as e:
+        print(f"error: bad/missing arguments ({e})", file=sys.stderr)
+        return 1
+
+    try:
+        control.cleanup(force, jobs, timeout)
+    except Exception as e:
+        print(f"error: cleanup failed ({e})", file=sys.stderr)
         return 1
 
 
 def main_deploy(control, args):
+    try:
+        wait = False
+        timeout = None
+        full = False
+        dry_run = False
+        downscale = False
+        check_capacity = True
+
+        while args:
+            arg = args.pop(0)
+            if arg == "--wait":
+                wait = True
+            elif arg == "-t":
+                timeout = float(args.pop(0))
+            elif arg == "--full":
+                full = True
+            elif arg in ["-n", "--dry-run"]:
+                dry_run = True
+            elif arg == "--downscale":
+                downscale = True
+            elif arg == "--no-capacity-check":
+                check_capacity = False
+            else:
+                raise Exception(f"unknown option ({arg})")
+    except Exception as e:
+        print(f"error: bad/missing arguments ({e})", file=sys.stderr)
+        return 1
+
     try:
         control.login()
-        control.deploy()
-    except:
-        print("error: deploy failed", file=sys.stderr)
+        control.deploy(wait, timeout, full, dry_run, downscale, check_capacity)
+    except Exception as e:
+        print(f"error: deploy failed ({e})", file=sys.stderr)
+        return 1
+
+
+def main_fleet(control, args):
+    """Run info, deploy, cleanup or build across many profiles."""
+
+    import json
+
+    from hpctcluster.charms import load_charms_config
+    from hpctcluster.fleet import Fleet
+
+    commands = {
+        "build": main_build,
+        "cleanup": main_cleanup,
+        "deploy": main_deploy,
+        "info": main_info,
+    }
+
+    try:
+        jobs = 4
+        profile_names = None
+        fleet_fresh = fresh
+
+        while args:
+            arg = args.pop(0)
+            if arg == "--fresh":
+                fleet_fresh = True
+            elif arg == "-j":
+                jobs = int(args.pop(0))
+            elif arg == "-p":
+                profile_names = args.pop(0).split(",")
+            else:
+                args.insert(0, arg)
+                break
+
+        cmd = args.pop(0)
+        if cmd not in commands:
+            raise Exception(f"unsupported fleet command ({cmd})")
+
+        work_dir = f"{top_dir}/work"
+        if profile_names == None:
+            profile_names = sorted(
+                [
+                    name
+                    for name in os.listdir(work_dir)
+                    if not name.startswith(".") and os.path.exists(f"{work_dir}/{name}/main.yaml")
+                ]
+            )
+    except Exception as e:
+        print(f"error: bad/missing arguments ({e})", file=sys.stderr)
+        return 1
+
+    controls = {}
+
+    def get_control(name):
+        if name not in controls:
+            controls[name] = Control(name, fleet_fresh)
+        return controls[name]
+
+    def run_cmd(name):
+        control = get_control(name)
+        control.login_prompt = False
+        return commands[cmd](control, list(args))
+
+    print(f"fleet: {cmd} on {len(profile_names)} clusters ({jobs} at a time)")
+    print()
+    if cmd in ["deploy", "info"]:
+        # log in here, one profile at a time (juju login may prompt),
+        # rather than from the workers
+        for name in profile_names:
+            try:
+                control = get_control(name)
+                if control.username != "root":
+                    control.login()
+            except BaseException:
+                # reported when run
+                controls.pop(name, None)
+    fleet = Fleet(profile_names, jobs)
+    if cmd == "build":
+        # profiles with identical charm sources share builds: one
+        # profile per group builds first, publishing to a shared cache
+        # that the others then restore from
+        groups = {}
+        for name in profile_names:
+            try:
+                control = get_control(name)
+                key = json.dumps(
+                    [load_charms_config(control.build_config_path), control.profile["charm"]],
+                    sort_keys=True,
+                    default=str,
+                )
+                if not control.charms_cache_dir:
+                    control.charms_cache_dir = f"{work_dir}/.fleet-charms-cache"
+            except BaseException:
+                # reported when run
+                controls.pop(name, None)
+                key = name
+            groups.setdefault(key, []).append(name)
+
+        leaders = [names[0] for names in groups.values()]
+        print(f"charm sources: {len(groups)} distinct")
+        print()
+        failed = fleet.run(run_cmd, leaders)
+        failed += fleet.run(run_cmd, [name for name in profile_names if name not in leaders])
+    else:
+        failed = fleet.run(run_cmd)
+
+    fleet.print_summary()
+    if failed:
         return 1
 
 
 def main_generate(control, args):
     try:
-        control.generate()
+        show = "--show" in args
+        control.generate(show)
     except:
         print("error: generate failed", file=sys.stderr)
         return 1
@@ -598,6 +1348,10 @@ def main_info(control, args):
 def main_init(control, args):
     """Initialize work directory and profile."""
 
+    import shutil
+
+    import yaml
+
     print("init running ...")
     try:
         src_profile_name = args.pop(0)
@@ -642,19 +1396,59 @@ def main_init(control, args):
     print("init completed")
 
 
+def parse_interview_args(args):
+    """Return (answers path, defaults, show) from args."""
+
+    answers_path = None
+    defaults = False
+    show = False
+
+    while args:
+        arg = args.pop(0)
+        if arg == "--answers":
+            answers_path = args.pop(0)
+        elif arg == "--defaults":
+            defaults = True
+        elif arg == "--show":
+            show = True
+        else:
+            raise Exception(f"unknown option ({arg})")
+
+    return answers_path, defaults, show
+
+
 def main_interview(control, args):
     try:
-        control.interview()
-        control.generate()
+        answers_path, defaults, show = parse_interview_args(args)
+    except Exception as e:
+        print(f"error: bad/missing arguments ({e})", file=sys.stderr)
+        return 1
+
+    try:
+        control.interview(answers_path, defaults)
+        control.generate(show)
     except:
         print("error: interview failed", file=sys.stderr)
         return 1
 
 
 def main_monitor(control, args):
+    try:
+        mode = None
+
+        while args:
+            arg = args.pop(0)
+            if arg in ["--plain", "--tui"]:
+                mode = arg[2:]
+            else:
+                raise Exception(f"unknown option ({arg})")
+    except Exception as e:
+        print(f"error: bad/missing arguments ({e})", file=sys.stderr)
+        return 1
+
     try:
         control.login()
-        control.monitor()
+        control.monitor(mode)
     except:
         print("error: monitor failed", file=sys.stderr)
         return 1
@@ -662,15 +1456,92 @@ def main_monitor(control, args):
 
 def main_prepare(control, args):
     try:
-        control.prepare()
+        answers_path, defaults, _ = parse_interview_args(args)
+    except Exception as e:
+        print(f"error: bad/missing arguments ({e})", file=sys.stderr)
+        return 1
+
+    try:
+        control.prepare(answers_path, defaults)
     except:
         print("error: prepare failed", file=sys.stderr)
         return 1
 
 
+def main_trace_report(control, args):
+    from hpctcluster.trace import report as trace_report
+
+    try:
+        count = 10
+        path = os.environ.get("HPCT_TRACE")
+
+        while args:
+            arg = args.pop(0)
+            if arg == "-n":
+                count = int(args.pop(0))
+            else:
+                path = arg
+
+        if not path:
+            raise Exception("missing trace file")
+        trace_report(path, count)
+    except Exception as e:
+        print(f"error: trace report failed ({e})", file=sys.stderr)
+        return 1
+
+
+def main_users(control, args):
+    try:
+        subcmd = args.pop(0)
+        if subcmd != "import":
+            raise Exception(f"unknown users command ({subcmd})")
+
+        batch_size = None
+        path = None
+        restart = False
+
+        while args:
+            arg = args.pop(0)
+            if arg == "-b":
+                batch_size = int(args.pop(0))
+            elif arg == "--restart":
+                restart = True
+            else:
+                path = arg
+    except Exception as e:
+        print(f"error: bad/missing arguments ({e})", file=sys.stderr)
+        return 1
+
+    try:
+        control.login()
+        return control.import_users(path, batch_size, restart)
+    except:
+        print("error: users import failed", file=sys.stderr)
+        return 1
+
+
 def main_setup(control, args):
     try:
-        control.setup()
+        headless = False
+        jobs = 4
+        redo = False
+
+        while args:
+            arg = args.pop(0)
+            if arg == "-j":
+                jobs = int(args.pop(0))
+            elif arg == "--headless":
+                headless = True
+            elif arg == "--redo":
+                redo = True
+            else:
+                raise Exception(f"unknown option ({arg})")
+    except Exception as e:
+        print(f"error: bad/missing arguments ({e})", file=sys.stderr)
+        return 1
+
+    try:
+        control.setup(jobs, redo, headless or not sys.stdin.isatty())
     except:
         print("error: setup failed", file=sys.stderr)
         return 1
@@ -693,7 +1564,7 @@ def main_setup_other(control, args):
 
 
 def main_setup_juju_user(control, args):
-    control._setup_juju_user()
+    control._setup_juju_user("--headless" in args or not sys.stdin.isatty())
 
 
 def main_show_interview_results(control, args):
@@ -705,11 +1576,14 @@ def print_usage():
     print(
         f"""\
 usage: {PROGNAME} init <profile>
-       {PROGNAME} [-p <profile>] <cmd> [<opts> ...] [<arg> ...]
+       {PROGNAME} [-p <profile>] [--fresh] <cmd> [<opts> ...] [<arg> ...]
        {PROGNAME} -h|--help
 
 Setup cluster. Each command supports its own options.
 
+Probe results (e.g., installed packages, juju readiness) are cached
+for a short time across invocations; "--fresh" ignores the cache.
+
 Typical steps are:
 * init
 * (as root) setup
@@ -718,17 +1592,54 @@ Typical steps are:
 * deploy
 
 Commands:
-build       Build charms.
-cleanup     Remove bundled applications.
-deploy      Deploy bundle.
+build       Build charms. Use "-j <n>" to build <n> charms at a time
+            and "-k" to keep going after a failed build. Unchanged
+            charms are skipped unless "--no-cache" is given.
+cleanup     Remove bundled applications ("-j <n>" removals at a time,
+            "-t <secs>" to time out, "--force").
+deploy      Deploy bundle. Only changes since the last deploy are
+            applied unless "--full" is given ("-n" to show them only).
+            Use "--wait" to follow units until all applications are
+            active ("-t <secs>" to time out). On the localhost cloud,
+            deploy first checks that the new machines fit the host
+            (cores, memory, storage pool space) and stops if not;
+            "--downscale" scales the compute nodes of the bundle
+            down to as many as fit (and saves it),
+            "--no-capacity-check" skips the check.
+fleet       Run info, deploy, cleanup or build (with its options)
+            across the profiles under work/ in one process ("-p
+            <profile>,..." after "fleet" to select, "-j <n>" clusters
+            at a time, "--fresh").
+            Output is shown per cluster. Profiles with the same charm
+            sources share charm builds.
 info        Report status and other information.
 init        Initialize working area and profile.
-interview   Run interview and generate bundle.
-monitor     Run status monitor in terminal window.
-prepare     Run steps: interview, info, build
+interview   Run interview and generate bundle ("--show" for a summary
+            of the bundle and the changes since the previous one).
+            With "--answers <file>" (YAML, by key) or "--defaults",
+            the interview runs without prompting, using defaults for
+            questions not answered.
+monitor     Run status monitor in terminal window. Use "--tui" or
+            "--plain" to monitor changes in the current terminal.
+prepare     Run steps: interview, info, build ("--answers <file>" or
+            "--defaults" as for interview)
+trace-report
+            Summarize a trace file (default: $HPCT_TRACE; "-n <count>"
+            entries per list).
+            Set HPCT_TRACE=<path> to trace external commands (JSONL,
+            or Chrome trace-event format if <path> ends in ".json").
+users       Import users to the ldap server: "users import [<file>]"
+            (CSV, or LDIF if <file> ends in ".ldif"; default: the
+            interview results). Users are validated first, then sent
+            in batches ("-b <size>"), one at a time.
+            Completed batches are kept: a re-run resumes, unless
+            "--restart" is given.
 
 Root commands (run as root):
-setup       Set up juju.
+setup       Set up juju. Independent steps run concurrently ("-j <n>"
+            at a time); completed steps are skipped on re-run unless
+            "--redo" is given. With "--headless" (or no terminal), the
+            juju user is registered without prompting.
 
 Commands marked with * must be run as root."""
     )
@@ -736,13 +1647,7 @@ Commands marked with * must be run as root."""
 
 def print_header():
     version = "0.1"
-    try:
-        commit = "-"
-        cp = run_capture(["git", "rev-parse", "HEAD"], text=True)
-        if cp.returncode == 0:
-            commit = cp.stdout.strip()
-    except:
-        pass
+    commit = get_git_commit(top_dir) or "-"
 
     name = f"hpct-cluster v{version}\n({commit})"
     uline = "=" * 48
@@ -762,30 +1667,76 @@ if __name__ == "__main__":
     vendordir = os.path.abspath(f"{top_dir}/vendor")
 
     profile_name = os.environ.get("HPCT_PROFILE")
+    fresh = False
+
+    commands = {
+        "build": main_build,
+        "cleanup": main_cleanup,
+        "deploy": main_deploy,
+        "fleet": main_fleet,
+        "info": main_info,
+        "init": main_init,
+        "interview": main_interview,
+        "monitor": main_monitor,
+        "prepare": main_prepare,
+        "setup": main_setup,
+        "trace-report": main_trace_report,
+        "users": main_users,
+        # unadvertised
+        "generate": main_generate,
+        "setup-charmcraft": main_setup_charmcraft,
+        "setup-juju": main_setup_juju,
+        "setup-juju-user": main_setup_juju_user,
+        "setup-lxd": main_setup_lxd,
+        "setup-other": main_setup_other,
+        "show-interview-results": main_show_interview_results,
+    }
 
     try:
         args = sys.argv[1:]
-        cmd = args.pop(0)
+        cmd = None
+        profile_arg = None
 
+        # global options, before (or right after) the command; fleet parses its own
         while args:
             arg = args.pop(0)
             if arg in ["-h", "--help"]:
                 print_usage()
                 sys.exit(0)
             elif arg == "-p":
-                profile_name = args.pop(0)
+                profile_arg = args.pop(0)
+            elif arg == "--fresh":
+                fresh = True
+            elif cmd == None:
+                cmd = arg
+                if cmd == "fleet":
+                    break
             else:
                 args.insert(0, arg)
                 break
 
-        if cmd in ["init"]:
+        if profile_arg != None:
+            if cmd == "fleet":
+                print("error: use 'fleet -p <profiles>' to select fleet profiles", file=sys.stderr)
+                sys.exit(1)
+            profile_name = profile_arg
+
+        if cmd == "help":
+            print_usage()
+            sys.exit(0)
+        elif cmd == None:
+            raise Exception("missing command")
+        elif cmd not in commands:
+            print(f"error: unknown command ({cmd})", file=sys.stderr)
+            sys.exit(1)
+
+        if cmd in ["fleet", "init", "trace-report"]:
             control = None
         elif profile_name == None:
             print("error: missing profile", file=sys.stderr)
             sys.exit(1)
         else:
-            control = Control(profile_name)
-            control.load_interview_results()
+            control = Control(profile_name, fresh)
     except SystemExit:
         raise
     except:
@@ -794,40 +1745,6 @@ if __name__ == "__main__":
 
     try:
         print_header()
-
-        if cmd == "build":
-            main_build(control, args)
-        elif cmd == "cleanup":
-            main_cleanup(control, args)
-        elif cmd == "deploy":
-            main_deploy(control, args)
-        elif cmd == "info":
-            main_info(control, args)
-        elif cmd == "init":
-            main_init(control, args)
-        elif cmd == "interview":
-            main_interview(control, args)
-        elif cmd == "monitor":
-            main_monitor(control, args)
-        elif cmd == "prepare":
-            main_prepare(control, args)
-        elif cmd == "setup":
-            main_setup(control, args)
-
-        # unadvertised
-        elif cmd == "generate":
-            main_generate(control, args)
-        elif cmd == "setup-charmcraft":
-            main_setup_charmcraft(control, args)
-        elif cmd == "setup-juju":
-            main_setup_juju(control, args)
-        elif cmd == "setup-juju-user":
-            main_setup_juju_user(control, args)
-        elif cmd == "setup-lxd":
-            main_setup_lxd(control, args)
-        elif cmd == "setup-other":
-            main_setup_other(control, args)
-        elif cmd == "show-interview-results":
-            main_show_interview_results(control, args)
+        commands[cmd](control, args)
     except:
         raise
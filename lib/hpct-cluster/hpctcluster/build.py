@@ -0,0 +1,192 @@
+#! /usr/bin/env python3
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+#
+# hpctcluster/build.py
+
+"""Charm build scheduler.
+
+Each charm is built by its own charms-builder process, with its own
+log file. Up to `jobs` builds run at the same time.
+"""
+
+import os
+import os.path
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from hpctcluster.lib import inherit_capture, run
+from hpctcluster.trace import inherit_phase
+
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+
+class BuildJob:
+    def __init__(self, name, cmdargs, log_path):
+        self.name = name
+        self.cmdargs = cmdargs
+        self.log_path = log_path
+        self.state = PENDING
+        self.returncode = None
+        self.start_time = None
+        self.end_time = None
+
+    def elapsed(self):
+        if self.start_time == None:
+            return None
+        return (self.end_time or time.time()) - self.start_time
+
+
+class BuildScheduler:
+    """Build charms concurrently.
+
+    With `keep_going` unset, the first failure stops any pending
+    builds from starting (running builds are allowed to finish).
+    """
+
+    def __init__(
+        self,
+        charms_builder_exec,
+        build_config_path,
+        work_dir,
+        charms_dir,
+        logs_dir,
+        series=None,
+        jobs=1,
+        keep_going=False,
+    ):
+        self.charms_builder_exec = charms_builder_exec
+        self.build_config_path = build_config_path
+        self.work_dir = work_dir
+        self.charms_dir = charms_dir
+        self.logs_dir = logs_dir
+        self.series = series
+        self.jobs = max(1, jobs)
+        self.keep_going = keep_going
+
+        self.build_jobs = []
+        self.interactive = sys.stdout.isatty()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._table_lines = 0
+
+    def _cmdargs(self, charm):
+        cmdargs = [
+            self.charms_builder_exec,
+            "build",
+            "-c",
+            self.build_config_path,
+            "-w",
+            self.work_dir,
+            "-C",
+            self.charms_dir,
+        ]
+        if self.series:
+            cmdargs.extend(["-s", self.series])
+        cmdargs.append(charm)
+        return cmdargs
+
+    def _run_job(self, job):
+        if self._stop.is_set():
+            job.state = SKIPPED
+            self._report(job)
+            return job
+
+        job.state = RUNNING
+        job.start_time = time.time()
+        self._report(job)
+
+        try:
+            with open(job.log_path, "wt") as f:
+                cp = run(job.cmdargs, stdout=f, stderr=subprocess.STDOUT, text=True)
+            job.returncode = cp.returncode
+        except Exception as e:
+            with open(job.log_path, "at") as f:
+                f.write(f"error: failed to run build ({e})\n")
+            job.returncode = -1
+
+        job.end_time = time.time()
+        job.state = DONE if job.returncode == 0 else FAILED
+        if job.state == FAILED and not self.keep_going:
+            self._stop.set()
+        self._report(job)
+        return job
+
+    def _format_row(self, job):
+        elapsed = job.elapsed()
+        elapsed = f"{elapsed:7.1f}s" if elapsed != None else " " * 8
+        return f"{job.name:40} {job.state:8} {elapsed}"
+
+    def _report(self, job):
+        with self._lock:
+            if self.interactive:
+                self._draw_table()
+            elif job.state != PENDING:
+                ndone = len([j for j in self.build_jobs if j.state in [DONE, FAILED, SKIPPED]])
+                print(f"[{ndone:>3}/{len(self.build_jobs)}] {self._format_row(job)}", flush=True)
+
+    def _draw_table(self):
+        if self._table_lines:
+            # move to the start of the table and redraw it in place
+            sys.stdout.write(f"\033[{self._table_lines}F")
+        for job in self.build_jobs:
+            sys.stdout.write(f"\033[K{self._format_row(job)}\n")
+        sys.stdout.flush()
+        self._table_lines = len(self.build_jobs)
+
+    def _tick(self, done):
+        while not done.wait(1):
+            with self._lock:
+                self._draw_table()
+
+    def print_summary(self):
+        print()
+        print(f"""{"charm":40} {"state":8} {"time":>8}""")
+        for job in self.build_jobs:
+            print(self._format_row(job))
+        print()
+        print(f"build logs: {self.logs_dir}")
+
+    def run(self, charms):
+        """Build charms and return the list of failed (or skipped)
+        jobs."""
+
+        os.makedirs(self.logs_dir, exist_ok=True)
+        self.build_jobs = [
+            BuildJob(charm, self._cmdargs(charm), f"{self.logs_dir}/{charm}.log")
+            for charm in charms
+        ]
+
+        print(f"building {len(self.build_jobs)} charms ({self.jobs} jobs) ...")
+        done = threading.Event()
+        if self.interactive:
+            self._report(None)
+            ticker = threading.Thread(target=self._tick, args=(done,), daemon=True)
+            ticker.start()
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                run_job = inherit_phase(inherit_capture(self._run_job))
+                futures = [executor.submit(run_job, job) for job in self.build_jobs]
+                for future in as_completed(futures):
+                    future.result()
+        finally:
+            done.set()
+            if self.interactive:
+                ticker.join()
+
+        if not self.interactive:
+            self.print_summary()
+        else:
+            print()
+            print(f"build logs: {self.logs_dir}")
+
+        return [job for job in self.build_jobs if job.state != DONE]
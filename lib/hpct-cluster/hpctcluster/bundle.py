@@ -5,135 +5,96 @@
 # hpctcluster/bundle.py
 
 import logging
+import os
+import os.path
+import shutil
 
-from hpctcluster.lib import DottedDictWrapper
+import yaml
 
-logger = logging.getLogger(__name__)
+from hpctcluster.lib import CompiledDottedDictWrapper
 
+logger = logging.getLogger(__name__)
 
-_BUNDLE_TEMPLATE = """
-name: hpct-cluster-bundle
-
-description: |
-  Set up cluster.
-
-#variables:
-
-series: jammy
-
-#tags:
-
-applications:
-  compute-node:
-    charm: %(charm_home)s/hpct-compute-node-operator_ubuntu-22.04-amd64.charm
-    #series: jammy
-    num_units: %(nodes.ncompute)s
-    constraints: cores=2 mem=8G
-
-  head-node:
-    charm: %(charm_home)s/hpct-head-node-operator_ubuntu-22.04-amd64.charm
-    #series: jammy
-    num_units: %(nodes.nhead)s
-    constraints: cores=2 mem=4G
-
-  interactive-node:
-    charm: %(charm_home)s/hpct-interactive-node-operator_ubuntu-22.04-amd64.charm
-    #series: jammy
-    num_units: %(nodes.ninteractive)s
-    constraints: cores=2 mem=4G
-
-  ldap-node:
-    charm: %(charm_home)s/hpct-ldap-node-operator_ubuntu-22.04-amd64.charm
-    #series: jammy
-    num_units: %(nodes.nldap)s
-    constraints: cores=2 mem=4G
-
-  nfs-node:
-    charm: %(charm_home)s/hpct-nfs-node-operator_ubuntu-22.04-amd64.charm
-    #series: jammy
-    num_units: 1
-    constraints: cores=2 mem=4G
-
-  slurm-node:
-    charm: %(charm_home)s/hpct-slurm-node-operator_ubuntu-22.04-amd64.charm
-    #series: jammy
-    num_units: %(nodes.nslurm)s
-    constraints: cores=2 mem=4G
-
-  #
-  # subordinates
-  #
-  ldap-client:
-    charm: %(charm_home)s/hpct-ldap-client-operator_ubuntu-22.04-amd64.charm
-    #series: jammy
-
-  ldap-server:
-    charm: %(charm_home)s/hpct-ldap-server-operator_ubuntu-22.04-amd64.charm
-    #series: jammy
-
-  slurm-client-compute:
-    charm: %(charm_home)s/hpct-slurm-client-operator_ubuntu-22.04-amd64.charm
-    #series: jammy
-
-  slurm-client:
-    charm: %(charm_home)s/hpct-slurm-client-operator_ubuntu-22.04-amd64.charm
-    #series: jammy
-
-  slurm-server:
-    charm: %(charm_home)s/hpct-slurm-server-operator_ubuntu-22.04-amd64.charm
-    #series: jammy
-
-relations:
-# compute-node
-- - compute-node:ldap-client-ready
-  - ldap-client:ldap-client-ready
-- - compute-node:slurm-client-ready
-  - slurm-client-compute:slurm-client-ready
-
-# head-node
-- - head-node:ldap-client-ready
-  - ldap-client:ldap-client-ready
-- - head-node:slurm-client-ready
-  - slurm-client:slurm-client-ready
-
-# interactive-node
-- - interactive-node:ldap-client-ready
-  - ldap-client:ldap-client-ready
-- - interactive-node:slurm-client-ready
-  - slurm-client:slurm-client-ready
-
-# ldap-node
-- - ldap-node:ldap-server-ready
-  - ldap-server:ldap-server-ready
-- - ldap-node:ldap-client-ready
-  - ldap-client:ldap-client-ready
-
-# nfs-node
-- - nfs-node:ldap-client-ready
-  - ldap-client:ldap-client-ready
-
-# slurm-node
-- - slurm-node:ldap-client-ready
-  - ldap-client:ldap-client-ready
-- - slurm-node:slurm-client-ready
-  - slurm-client:slurm-client-ready
-- - slurm-node:slurm-server-ready
-  - slurm-server:slurm-server-ready
-
-# ldap-client
-- - ldap-server:ldap-info
-  - ldap-client:ldap-info
-
-# slurm-client
-- - slurm-client:slurm-controller
-  - slurm-server:slurm-controller
-
-# slurm-client-compute
-- - slurm-client-compute:slurm-controller
-  - slurm-server:slurm-controller
-- - slurm-client-compute:slurm-compute
-  - slurm-server:slurm-compute
-"""
+# libyaml-based, if available
+YAML_DUMPER = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+BUNDLE_NAME = "hpct-cluster-bundle"
+BUNDLE_DESCRIPTION = "Set up cluster."
+BUNDLE_SERIES = "jammy"
+DEFAULT_RUN_ON = "ubuntu-22.04-amd64"
+
+# principal applications: charm, interview key for number of units
+# (fixed count if None), default constraints
+BUNDLE_ROLES = {
+    "compute-node": {
+        "charm": "hpct-compute-node-operator",
+        "units": "nodes.ncompute",
+        "constraints": "cores=2 mem=8G",
+    },
+    "head-node": {
+        "charm": "hpct-head-node-operator",
+        "units": "nodes.nhead",
+        "constraints": "cores=2 mem=4G",
+    },
+    "interactive-node": {
+        "charm": "hpct-interactive-node-operator",
+        "units": "nodes.ninteractive",
+        "constraints": "cores=2 mem=4G",
+    },
+    "ldap-node": {
+        "charm": "hpct-ldap-node-operator",
+        "units": "nodes.nldap",
+        "constraints": "cores=2 mem=4G",
+    },
+    "nfs-node": {
+        "charm": "hpct-nfs-node-operator",
+        "units": None,
+        "constraints": "cores=2 mem=4G",
+    },
+    "slurm-node": {
+        "charm": "hpct-slurm-node-operator",
+        "units": "nodes.nslurm",
+        "constraints": "cores=2 mem=4G",
+    },
+}
+
+BUNDLE_SUBORDINATES = {
+    "ldap-client": "hpct-ldap-client-operator",
+    "ldap-server": "hpct-ldap-server-operator",
+    "slurm-client-compute": "hpct-slurm-client-operator",
+    "slurm-client": "hpct-slurm-client-operator",
+    "slurm-server": "hpct-slurm-server-operator",
+}
+
+BUNDLE_RELATIONS = [
+    # compute-node
+    ("compute-node:ldap-client-ready", "ldap-client:ldap-client-ready"),
+    ("compute-node:slurm-client-ready", "slurm-client-compute:slurm-client-ready"),
+    # head-node
+    ("head-node:ldap-client-ready", "ldap-client:ldap-client-ready"),
+    ("head-node:slurm-client-ready", "slurm-client:slurm-client-ready"),
+    # interactive-node
+    ("interactive-node:ldap-client-ready", "ldap-client:ldap-client-ready"),
+    ("interactive-node:slurm-client-ready", "slurm-client:slurm-client-ready"),
+    # ldap-node
+    ("ldap-node:ldap-server-ready", "ldap-server:ldap-server-ready"),
+    ("ldap-node:ldap-client-ready", "ldap-client:ldap-client-ready"),
+    # nfs-node
+    ("nfs-node:ldap-client-ready", "ldap-client:ldap-client-ready"),
+    # slurm-node
+    ("slurm-node:ldap-client-ready", "ldap-client:ldap-client-ready"),
+    ("slurm-node:slurm-client-ready", "slurm-client:slurm-client-ready"),
+    ("slurm-node:slurm-server-ready", "slurm-server:slurm-server-ready"),
+    # ldap-client
+    ("ldap-server:ldap-info", "ldap-client:ldap-info"),
+    # slurm-client
+    ("slurm-client:slurm-controller", "slurm-server:slurm-controller"),
+    # slurm-client-compute
+    ("slurm-client-compute:slurm-controller", "slurm-server:slurm-controller"),
+    ("slurm-client-compute:slurm-compute", "slurm-server:slurm-compute"),
+]
 
 BUNDLE_APPNAMES = [
     "compute-node",
@@ -149,11 +110,468 @@ BUNDLE_APPNAMES = [
     "slurm-server",
 ]
 
+BUNDLE_SUBORDINATE_APPNAMES = [
+    "ldap-client",
+    "ldap-server",
+    "slurm-client",
+    "slurm-client-compute",
+    "slurm-server",
+]
+
+# machine size limit for packing, if neither the interview nor the host
+# capacity gives one
+DEFAULT_MACHINE_MAX = "cores=8 mem=32G"
+
+_MEM_UNITS = {"M": 1, "G": 1024, "T": 1024 * 1024}
+
+
+def parse_constraints(constraints):
+    """Return {"cores": int, "mem": MiB} (other constraints ignored)
+    from a constraints string ("cores=2 mem=4G")."""
+
+    d = {"cores": 0, "mem": 0}
+    for item in str(constraints or "").split():
+        k, _, v = item.partition("=")
+        if k == "cores":
+            d["cores"] = int(v)
+        elif k == "mem":
+            if v[-1:].upper() in _MEM_UNITS:
+                d["mem"] = int(float(v[:-1]) * _MEM_UNITS[v[-1:].upper()])
+            else:
+                d["mem"] = int(v)
+    return d
 
-def generate_bundle(config, filename):
-    dd = DottedDictWrapper(config, ".")
 
-    with open(filename, "wt") as f:
-        f.write(_BUNDLE_TEMPLATE % dd)
+def format_constraints(d):
+    mem = d["mem"]
+    mem = f"{mem // 1024}G" if mem % 1024 == 0 else f"{mem}M"
+    return f"""cores={d["cores"]} mem={mem}"""
+
+
+def plan_packing(units, machine_max, anti_affinity=None, isolate=None):
+    """Pack units onto as few machines as fit (first fit, largest
+    units first).
 
-    print(_BUNDLE_TEMPLATE % dd)
+    units is a list of (appname, {"cores", "mem"}), one per unit. Units
+    of one application never share a machine, nor do applications in
+    the same anti_affinity group; isolate lists applications that share
+    with no other application. A machine holds at most machine_max
+    (units larger than that get a machine of their own).
+
+    Return list of machines, each {"appnames": [...], "cores", "mem"},
+    and, per unit (in order), the index of its machine.
+    """
+
+    anti_affinity = [set(group) for group in anti_affinity or []]
+    isolate = set(isolate or [])
+
+    def conflicts(appname, machine):
+        for other in machine["appnames"]:
+            if other == appname or appname in isolate or other in isolate:
+                return True
+            for group in anti_affinity:
+                if appname in group and other in group:
+                    return True
+        return False
+
+    machines = []
+    placement = [None] * len(units)
+    order = sorted(
+        range(len(units)), key=lambda i: (-units[i][1]["mem"], -units[i][1]["cores"], units[i][0])
+    )
+    for i in order:
+        appname, need = units[i]
+        for index, machine in enumerate(machines):
+            if (
+                not conflicts(appname, machine)
+                and machine["cores"] + need["cores"] <= machine_max["cores"]
+                and machine["mem"] + need["mem"] <= machine_max["mem"]
+            ):
+                break
+        else:
+            machines.append({"appnames": [], "cores": 0, "mem": 0})
+            index = len(machines) - 1
+
+        machine = machines[index]
+        machine["appnames"].append(appname)
+        machine["cores"] += need["cores"]
+        machine["mem"] += need["mem"]
+        placement[i] = index
+
+    return machines, placement
+
+
+def is_packing(config):
+    """Return whether the interview results ask for packing."""
+
+    value = CompiledDottedDictWrapper(config, ".").get("placement.pack", "n")
+    return str(value).lower() in ["y", "yes", "true"]
+
+
+def _split_groups(value):
+    """Split "a,b;c,d" into [["a", "b"], ["c", "d"]]."""
+
+    groups = [[v.strip() for v in group.split(",") if v.strip()] for group in value.split(";")]
+    return [group for group in groups if group]
+
+
+def _expand_placement(placement, num_units):
+    """Expand comma-separated placement directives to one per unit
+    (the last directive is repeated). "new" (or nothing) means no
+    placement."""
+
+    directives = [v.strip() for v in str(placement or "").split(",") if v.strip()]
+    if not directives or directives == ["new"]:
+        return None
+    directives.extend([directives[-1]] * (num_units - len(directives)))
+    return directives[:num_units]
+
+
+def placement_machine(directive):
+    """Return machine id of a placement directive ("0", "lxd:0"), if
+    any."""
+
+    machine = directive.split(":")[-1]
+    return machine if machine.isdigit() else None
+
+
+def active_appnames(bundle):
+    """Return names of the applications of bundle that get units:
+    those with units, and subordinates related to any of them."""
+
+    applications = bundle.get("applications") or {}
+    appnames = [name for name, app in applications.items() if app.get("num_units", 0) > 0]
+    related = set()
+    for relation in bundle.get("relations") or []:
+        names = [endpoint.split(":")[0] for endpoint in relation]
+        if set(names) & set(appnames):
+            related.update(names)
+    return appnames + [
+        name for name, app in applications.items() if "num_units" not in app and name in related
+    ]
+
+
+def scale_application(bundle, appname, num_units):
+    """Return copy of bundle with application appname scaled down to
+    num_units (and its placements); bundle machines no longer used
+    are dropped. bundle itself is not changed."""
+
+    app = dict(bundle["applications"][appname], num_units=num_units)
+    if "to" in app:
+        app["to"] = app["to"][:num_units]
+    bundle = dict(bundle, applications=dict(bundle["applications"], **{appname: app}))
+
+    if "machines" in bundle:
+        used = set()
+        for app in bundle["applications"].values():
+            used.update([placement_machine(str(directive)) for directive in app.get("to", [])])
+        bundle["machines"] = {k: v for k, v in bundle["machines"].items() if str(k) in used}
+        if not bundle["machines"]:
+            del bundle["machines"]
+    return bundle
+
+
+def build_bundle(config, capacity=None):
+    """Build bundle (as data) from interview results.
+
+    Per-role settings come from the interview:
+    * nodes.n<role> - number of units
+    * constraints.<role> - constraints (e.g., "cores=2 mem=4G")
+    * placement.<role> - comma-separated "to:" directives (e.g.,
+      "lxd:0"), "new" for a machine per unit
+    * machines.<id>.constraints - constraints for placement machines
+
+    With placement.pack set ("y"), units of roles without directives
+    are packed onto shared machines (see plan_packing()):
+    * placement.machine-max - machine size limit (default: capacity,
+      the host capacity, if given)
+    * placement.isolate - comma-separated roles not to share machines
+    * placement.anti-affinity - ";"-separated groups of
+      comma-separated roles not to share machines with each other
+    """
+
+    dd = CompiledDottedDictWrapper(config, ".")
+    charm_home = dd.get("charm_home", ".")
+    run_on = dd.get("run-on") or DEFAULT_RUN_ON
+
+    applications = {}
+    machines = {}
+    for appname, role in BUNDLE_ROLES.items():
+        num_units = int(dd.get(role["units"], 1)) if role["units"] else 1
+        app = {
+            "charm": f"""{charm_home}/{role["charm"]}_{run_on}.charm""",
+            "num_units": num_units,
+            "constraints": dd.get(f"constraints.{appname}") or role["constraints"],
+        }
+
+        to = _expand_placement(dd.get(f"placement.{appname}"), num_units)
+        if to:
+            app["to"] = to
+            for directive in to:
+                machine = placement_machine(directive)
+                if machine != None and machine not in machines:
+                    machines[machine] = {}
+                    constraints = dd.get(f"machines.{machine}.constraints")
+                    if constraints:
+                        machines[machine]["constraints"] = constraints
+
+        applications[appname] = app
+
+    if is_packing(config):
+        _pack_applications(dd, applications, machines, capacity)
+
+    for appname, charm in BUNDLE_SUBORDINATES.items():
+        applications[appname] = {"charm": f"{charm_home}/{charm}_{run_on}.charm"}
+
+    bundle = {
+        "name": BUNDLE_NAME,
+        "description": BUNDLE_DESCRIPTION,
+        "series": BUNDLE_SERIES,
+        "applications": applications,
+    }
+    if machines:
+        bundle["machines"] = {k: machines[k] for k in sorted(machines, key=int)}
+    bundle["relations"] = [list(relation) for relation in BUNDLE_RELATIONS]
+
+    return bundle
+
+
+def _pack_applications(dd, applications, machines, capacity):
+    """Place units of applications without "to:" directives on packed
+    machines (added to machines)."""
+
+    units = []
+    for appname, app in applications.items():
+        if "to" not in app:
+            need = parse_constraints(app["constraints"])
+            units.extend([(appname, need)] * app["num_units"])
+    if not units:
+        return
+
+    machine_max = parse_constraints(
+        dd.get("placement.machine-max")
+        or (format_constraints(capacity) if capacity else DEFAULT_MACHINE_MAX)
+    )
+    anti_affinity = _split_groups(str(dd.get("placement.anti-affinity") or ""))
+    isolate = sum(_split_groups(str(dd.get("placement.isolate") or "")), [])
+    packed, placement = plan_packing(units, machine_max, anti_affinity, isolate)
+
+    first = max([int(k) for k in machines] + [-1]) + 1
+    for index, machine in enumerate(packed):
+        machines[str(first + index)] = {"constraints": format_constraints(machine)}
+    for (appname, _), index in zip(units, placement):
+        applications[appname].setdefault("to", []).append(str(first + index))
+
+
+def diff_bundles(old, new):
+    """Return list of changes (strings) between two bundles."""
+
+    changes = []
+    old_apps = (old or {}).get("applications") or {}
+    new_apps = new.get("applications") or {}
+    for appname in sorted(set(old_apps) | set(new_apps)):
+        if appname not in old_apps:
+            changes.append(f"application {appname}: added")
+        elif appname not in new_apps:
+            changes.append(f"application {appname}: removed")
+        else:
+            for k in sorted(set(old_apps[appname]) | set(new_apps[appname])):
+                o, n = old_apps[appname].get(k), new_apps[appname].get(k)
+                if o != n:
+                    changes.append(f"application {appname}: {k}: {o} -> {n}")
+
+    old_machines = (old or {}).get("machines") or {}
+    new_machines = new.get("machines") or {}
+    for machine in sorted(set(old_machines) | set(new_machines), key=str):
+        if old_machines.get(machine) != new_machines.get(machine):
+            changes.append(
+                f"machine {machine}: {old_machines.get(machine)} -> {new_machines.get(machine)}"
+            )
+
+    old_relations = set([tuple(r) for r in (old or {}).get("relations") or []])
+    new_relations = set([tuple(r) for r in new.get("relations") or []])
+    for relation in sorted(new_relations - old_relations):
+        changes.append(f"""relation {" ".join(relation)}: added""")
+    for relation in sorted(old_relations - new_relations):
+        changes.append(f"""relation {" ".join(relation)}: removed""")
+
+    return changes
+
+
+def _write_item(f, item, indent):
+    """Write item (a one-entry mapping or one-item list) as YAML,
+    indented."""
+
+    text = yaml.dump(item, Dumper=YAML_DUMPER, default_flow_style=False, sort_keys=False)
+    for line in text.splitlines(True):
+        f.write(f"{indent}{line}")
+
+
+def _write_entry(f, k, v, indent=""):
+    """Write "k: v" as YAML, mappings and lists one entry/item at a
+    time."""
+
+    if isinstance(v, (dict, list)) and v:
+        key = yaml.dump(k, Dumper=YAML_DUMPER).splitlines()[0]
+        f.write(f"{indent}{key}:\n")
+        if isinstance(v, dict):
+            for k2, v2 in v.items():
+                _write_entry(f, k2, v2, f"{indent}  ")
+        else:
+            for item in v:
+                _write_item(f, [item], indent)
+    else:
+        _write_item(f, {k: v}, indent)
+
+
+def write_bundle(bundle, f):
+    """Write bundle to f as YAML, a piece at a time (so that no YAML
+    text of the whole bundle is held in memory)."""
+
+    for k, v in bundle.items():
+        _write_entry(f, k, v)
+
+
+def print_bundle_summary(bundle):
+    """Print applications (units, constraints, machines used) and
+    machines of bundle."""
+
+    print(f"""{"application":24} {"units":>6} {"machines":>8}  constraints""")
+    for appname, app in bundle["applications"].items():
+        machines = set([placement_machine(directive) for directive in app.get("to", [])])
+        machines.discard(None)
+        print(
+            f"""{appname:24} {app.get("num_units", "-"):>6} {len(machines) or "-":>8}"""
+            f"""  {app.get("constraints") or "-"}"""
+        )
+    for machine, d in bundle.get("machines", {}).items():
+        print(f"""machine {machine}: {d.get("constraints") or "-"}""")
+
+
+def print_bundle_stats(bundle):
+    applications = bundle["applications"]
+    nunits = sum([app.get("num_units", 0) for app in applications.values()])
+    print(
+        f"bundle: {len(applications)} applications, {nunits} units,"
+        f""" {len(bundle.get("machines", {}))} machines, {len(bundle["relations"])} relations"""
+    )
+
+
+def save_bundle(bundle, filename):
+    """Write bundle file, keeping the previous one (as
+    <filename>.prev). The file is replaced atomically. The previous
+    bundle is not loaded (see load_bundle())."""
+
+    tmp = f"{filename}.tmp.{os.getpid()}"
+    try:
+        with open(tmp, "wt") as f:
+            write_bundle(bundle, f)
+
+        if os.path.exists(filename):
+            prev = f"{filename}.prev"
+            if os.path.exists(prev):
+                os.remove(prev)
+            try:
+                os.link(filename, prev)
+            except:
+                shutil.copyfile(filename, prev)
+        os.replace(tmp, filename)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def load_bundle(filename):
+    """Return bundle loaded from file, or None if missing or bad."""
+
+    try:
+        with open(filename) as f:
+            return yaml.load(f, Loader=YAML_LOADER)
+    except:
+        return None
+
+
+def generate_bundle(config, filename, capacity=None, show=False):
+    """Generate bundle file, keeping the previous one (as
+    <filename>.prev). With show, also report a summary of the bundle
+    and what changed since the previous one (only then is the
+    previous bundle loaded).
+
+    The file is replaced atomically: it is either the previous or the
+    complete new bundle.
+    """
+
+    bundle = build_bundle(config, capacity)
+    save_bundle(bundle, filename)
+    print_bundle_stats(bundle)
+    if show:
+        print_bundle_summary(bundle)
+        old = load_bundle(f"{filename}.prev")
+        if old != None:
+            changes = diff_bundles(old, bundle)
+            print(f"changes since previous bundle: {len(changes)}")
+            for change in changes:
+                print(f"  {change}")
+
+    return bundle
+
+
+def plan_redeploy(old, new, status, old_hashes, new_hashes):
+    """Plan changes to get from the deployed bundle (and live model
+    status) to a new bundle.
+
+    Return a list of actions:
+    * ("add-unit", appname, count)
+    * ("remove-unit", appname, [unitname, ...])
+    * ("refresh", appname, charmpath)
+    * ("relate", endpoint1, endpoint2)
+    * ("remove-relation", endpoint1, endpoint2)
+
+    Return None if the change cannot be made incrementally (e.g.,
+    applications, machines, constraints or placement changed) and the
+    bundle must be deployed in full.
+    """
+
+    old_apps = old.get("applications") or {}
+    new_apps = new.get("applications") or {}
+    live_apps = (status or {}).get("applications") or {}
+
+    if set(old_apps) != set(new_apps) or not set(new_apps).issubset(live_apps):
+        return None
+    if (old.get("machines") or {}) != (new.get("machines") or {}):
+        return None
+
+    actions = []
+    for appname, app in new_apps.items():
+        old_app = old_apps[appname]
+        for k in set(app) | set(old_app):
+            if k not in ["charm", "num_units"] and app.get(k) != old_app.get(k):
+                return None
+
+        charm_changed = app["charm"] != old_app["charm"]
+        if charm_changed or new_hashes.get(appname) != old_hashes.get(appname):
+            actions.append(("refresh", appname, app["charm"]))
+
+        if "num_units" not in app:
+            # subordinate
+            continue
+        units = sorted(
+            (live_apps[appname].get("units") or {}).keys(),
+            key=lambda name: int(name.split("/")[-1]),
+        )
+        if app["num_units"] > len(units):
+            if app.get("to"):
+                # bundle machine ids do not map to model machine ids
+                return None
+            actions.append(("add-unit", appname, app["num_units"] - len(units)))
+        elif app["num_units"] < len(units):
+            actions.append(("remove-unit", appname, units[app["num_units"] :]))
+
+    old_relations = set([tuple(r) for r in old.get("relations") or []])
+    new_relations = set([tuple(r) for r in new.get("relations") or []])
+    for relation in sorted(old_relations - new_relations):
+        actions.append(("remove-relation", *relation))
+    for relation in sorted(new_relations - old_relations):
+        actions.append(("relate", *relation))
+
+    return actions
@@ -0,0 +1,140 @@
+#! /usr/bin/env python3
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+#
+# hpctcluster/capacity.py
+
+"""Pre-flight capacity check (deploy).
+
+Compares what a deploy would add (new machines, from the bundle and
+the units already in the model) with what the host has left: host
+cores and memory less what the machines of the model hold, and free
+space in the LXD storage pool. Machines that would not fit stay
+pending; this reports that before deploying.
+
+Only machines count: on the localhost cloud, a container on a machine
+("0/lxd/1", "lxd:0") runs inside that machine's LXD container, within
+its resources.
+"""
+
+from hpctcluster.bundle import parse_constraints, placement_machine
+
+
+RESOURCES = ["cores", "mem", "disk"]
+
+# root disk (MiB) assumed for a new machine without a root-disk
+# constraint
+DEFAULT_ROOT_DISK = 4096
+
+
+def _root_disk(constraints):
+    for item in str(constraints or "").split():
+        k, _, v = item.partition("=")
+        if k == "root-disk":
+            return parse_constraints(f"mem={v}")["mem"]
+    return DEFAULT_ROOT_DISK
+
+
+def _need(constraints):
+    d = parse_constraints(constraints)
+    d["disk"] = _root_disk(constraints)
+    return d
+
+
+def _add(total, need):
+    total["machines"] += 1
+    for k in RESOURCES:
+        total[k] += need.get(k, 0)
+
+
+def _zero():
+    return {"machines": 0, "cores": 0, "mem": 0, "disk": 0}
+
+
+def model_usage(status):
+    """Return cores and memory held by the machines of the model, from
+    model status. Containers (within their machines) are not
+    counted."""
+
+    usage = _zero()
+    for machine in ((status or {}).get("machines") or {}).values():
+        # hardware once provisioned, constraints until then
+        _add(usage, parse_constraints(machine.get("hardware") or machine.get("constraints")))
+    return usage
+
+
+def bundle_demand(bundle, status=None):
+    """Return machines, cores, memory and disk needed for the units of
+    bundle that are not in the model (status) yet.
+
+    Units follow their placement ("to") directives: a new machine (no
+    directive, "new" or "lxd") or a bundle machine, directly or in a
+    container ("lxd:0"; counted once, with its constraints, if the
+    model is empty).
+    """
+
+    live_apps = (status or {}).get("applications") or {}
+    existing = {appname: len(app.get("units") or {}) for appname, app in live_apps.items()}
+    machines = (bundle.get("machines") or {}) if not any(existing.values()) else {}
+
+    demand = _zero()
+    used_machines = set()
+    for appname, app in bundle["applications"].items():
+        if "num_units" not in app:
+            # subordinate
+            continue
+        need = _need(app.get("constraints"))
+        to = app.get("to") or []
+        for i in range(existing.get(appname, 0), app["num_units"]):
+            directive = to[i] if i < len(to) else "new"
+            machine = placement_machine(directive)
+            if machine == None:
+                _add(demand, need)
+            elif str(machine) in machines:
+                used_machines.add(str(machine))
+
+    for machine in sorted(used_machines, key=int):
+        _add(demand, _need(machines[machine].get("constraints")))
+    return demand
+
+
+def _available(host, usage, k):
+    if host.get(k) == None:
+        return None
+    # disk is free space already
+    return host[k] - usage[k] if k != "disk" else host[k]
+
+
+def check(host, usage, demand):
+    """Return list of (resource, demand, available) that do not fit.
+    host is {"cores", "mem", "disk"} (a value of None is not
+    checked); disk is free space, other resources are totals."""
+
+    short = []
+    for k in RESOURCES:
+        available = _available(host, usage, k)
+        if available != None and demand[k] > available:
+            short.append((k, demand[k], available))
+    return short
+
+
+def _format(k, v):
+    if v == None:
+        return "-"
+    if k in ["mem", "disk"]:
+        return f"{v / 1024:.1f}G"
+    return str(v)
+
+
+def print_report(host, usage, demand):
+    short = [k for k, _, _ in check(host, usage, demand)]
+    print(f"""{"resource":10} {"host":>10} {"in use":>10} {"available":>10} {"demand":>10}""")
+    for k in RESOURCES:
+        available = _available(host, usage, k)
+        print(
+            f"{k:10} {_format(k, host.get(k)):>10}"
+            f""" {_format(k, usage[k] if k != "disk" else None):>10}"""
+            f" {_format(k, available):>10} {_format(k, demand[k]):>10}"
+            + (f"  short by {_format(k, demand[k] - available)}" if k in short else "")
+        )
+    print(f"""new machines: {demand["machines"]} (model has {usage["machines"]})""")
@@ -0,0 +1,284 @@
+#! /usr/bin/env python3
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+#
+# hpctcluster/charms.py
+
+"""Charm build cache.
+
+Built charms are keyed on (charm name, source commit, run-on base,
+charmcraft version). The index of what is in a charms directory is
+kept in the charms directory itself; an optional shared cache
+directory (usable across profiles and hosts) holds one copy of each
+built charm per key.
+"""
+
+import hashlib
+import json
+import os
+import os.path
+import shutil
+import threading
+
+import yaml
+
+from hpctcluster.lib import run_capture
+
+
+INDEX_NAME = ".cache-index.json"
+
+
+def charm_filename(name, run_on):
+    return f"{name}_{run_on}.charm"
+
+
+def load_charms_config(path):
+    """Load charms section of charms-builder configuration."""
+
+    y = yaml.safe_load(open(path).read())
+    return y.get("charms") or {}
+
+
+def get_charmcraft_version():
+    try:
+        cp = run_capture(["charmcraft", "version"], text=True, timeout=30)
+        if cp.returncode == 0 and cp.stdout.split():
+            return cp.stdout.split()[-1]
+    except:
+        pass
+    return None
+
+
+def get_source_commit(repo, branch=None):
+    """Return commit of repo branch (or HEAD) without cloning."""
+
+    try:
+        cp = run_capture(["git", "ls-remote", repo, branch or "HEAD"], text=True, timeout=30)
+        if cp.returncode == 0 and cp.stdout.split():
+            return cp.stdout.split()[0]
+    except:
+        pass
+    return None
+
+
+class CharmCache:
+    def __init__(self, charms_dir, run_on, shared_dir=None):
+        self.charms_dir = charms_dir
+        self.run_on = run_on
+        self.shared_dir = shared_dir
+        self.index_path = f"{charms_dir}/{INDEX_NAME}"
+        self.index = self._load_index()
+
+    def _load_index(self):
+        try:
+            return json.loads(open(self.index_path).read())
+        except:
+            return {}
+
+    def _copy(self, src, dst):
+        """Copy file via temporary file so readers never see partial
+        files."""
+
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        tmp = f"{dst}.tmp.{os.getpid()}.{threading.get_ident()}"
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+
+    def _shared_path(self, name, key_hash):
+        return f"{self.shared_dir}/{key_hash}/{charm_filename(name, self.run_on)}"
+
+    def charm_path(self, name):
+        return f"{self.charms_dir}/{charm_filename(name, self.run_on)}"
+
+    def get(self, name):
+        """Return index entry for a charm, if the charm file is present
+        and unchanged since it was recorded."""
+
+        entry = self.index.get(name)
+        if entry == None:
+            return None
+        try:
+            st = os.stat(self.charm_path(name))
+            if st.st_size != entry["size"] or st.st_mtime != entry["mtime"]:
+                return None
+        except:
+            return None
+        return entry
+
+    def lookup(self, name, key_hash):
+        """Return "hit" if the charm is built for the key, "restored"
+        if it was copied in from the shared cache, or None."""
+
+        entry = self.get(name)
+        if entry != None and entry["hash"] == key_hash:
+            return "hit"
+
+        if self.shared_dir:
+            path = self._shared_path(name, key_hash)
+            if os.path.exists(path):
+                self._copy(path, self.charm_path(name))
+                self._record(name, self.index_key(name, key_hash), key_hash)
+                return "restored"
+        return None
+
+    def index_key(self, name, key_hash):
+        """Return stored key for a hash (from the shared cache)."""
+
+        try:
+            return json.loads(open(f"{self.shared_dir}/{key_hash}/key.json").read())
+        except:
+            return {"name": name, "run-on": self.run_on}
+
+    def make_key(self, name, commit, charmcraft_version, series=None):
+        """Return (key, key_hash), or (key, None) when the key is not
+        fully known (and the charm must be built). series is the series
+        the charm is built for (build -s), if not the default."""
+
+        key = {
+            "name": name,
+            "commit": commit,
+            "run-on": self.run_on,
+            "charmcraft": charmcraft_version,
+        }
+        if None in key.values():
+            return key, None
+        if series:
+            key["series"] = series
+
+        key_hash = hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+        return key, key_hash
+
+    def _record(self, name, key, key_hash):
+        st = os.stat(self.charm_path(name))
+        self.index[name] = {
+            "hash": key_hash,
+            "key": key,
+            "size": st.st_size,
+            "mtime": st.st_mtime,
+        }
+
+    def save(self):
+        os.makedirs(self.charms_dir, exist_ok=True)
+        tmp = f"{self.index_path}.tmp.{os.getpid()}"
+        with open(tmp, "wt") as f:
+            json.dump(self.index, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.index_path)
+
+    def store(self, name, key, key_hash):
+        """Record a newly built charm and publish it to the shared
+        cache."""
+
+        if key_hash == None or not os.path.exists(self.charm_path(name)):
+            self.index.pop(name, None)
+            return
+
+        self._record(name, key, key_hash)
+        if self.shared_dir:
+            path = self._shared_path(name, key_hash)
+            if not os.path.exists(path):
+                self._copy(self.charm_path(name), path)
+                key_path = f"{os.path.dirname(path)}/key.json"
+                tmp = f"{key_path}.tmp.{os.getpid()}.{threading.get_ident()}"
+                with open(tmp, "wt") as f:
+                    json.dump(key, f, indent=2, sort_keys=True)
+                os.replace(tmp, key_path)
+
+
+class CharmInventory:
+    """Per-charm records (built or not) for a charms directory.
+
+    Records are kept in a manifest file and only recomputed when the
+    charms directory or the build configuration changes.
+    """
+
+    def __init__(self, build_config_path, charms_dir, run_on, manifest_path):
+        self.build_config_path = build_config_path
+        self.charms_dir = charms_dir
+        self.run_on = run_on
+        self.manifest_path = manifest_path
+
+    def _stamp(self):
+        stamp = {"run-on": self.run_on}
+        for name, path in [("config", self.build_config_path), ("charms", self.charms_dir)]:
+            try:
+                stamp[name] = os.stat(path).st_mtime_ns
+            except:
+                stamp[name] = None
+        return stamp
+
+    def _file_hash(self, path):
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def _is_current(self, records):
+        """Check for charm files rewritten in place (which does not
+        change the directory)."""
+
+        for record in records.values():
+            try:
+                st = os.stat(record["path"])
+                if (st.st_size, st.st_mtime) != (record["size"], record["mtime"]):
+                    return False
+            except:
+                if record["built"]:
+                    return False
+        return True
+
+    def _scan(self):
+        cache = CharmCache(self.charms_dir, self.run_on)
+        records = {}
+        for name in sorted(load_charms_config(self.build_config_path)):
+            path = cache.charm_path(name)
+            record = {
+                "name": name,
+                "path": path,
+                "base": self.run_on,
+                "built": False,
+                "cached": False,
+                "size": None,
+                "mtime": None,
+                "hash": None,
+            }
+            try:
+                st = os.stat(path)
+            except:
+                records[name] = record
+                continue
+
+            entry = cache.get(name)
+            record.update(
+                {
+                    "built": True,
+                    "cached": entry != None,
+                    "size": st.st_size,
+                    "mtime": st.st_mtime,
+                    "hash": entry["hash"] if entry else self._file_hash(path),
+                }
+            )
+            records[name] = record
+        return records
+
+    def get(self, refresh=False):
+        """Return records keyed by charm name."""
+
+        stamp = self._stamp()
+        if not refresh:
+            try:
+                manifest = json.loads(open(self.manifest_path).read())
+                if manifest["stamp"] == stamp and self._is_current(manifest["charms"]):
+                    return manifest["charms"]
+            except:
+                pass
+
+        records = self._scan()
+        try:
+            tmp = f"{self.manifest_path}.tmp.{os.getpid()}"
+            with open(tmp, "wt") as f:
+                json.dump({"stamp": stamp, "charms": records}, f, indent=2, sort_keys=True)
+            os.replace(tmp, self.manifest_path)
+        except:
+            pass
+        return records
@@ -0,0 +1,97 @@
+#! /usr/bin/env python3
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+#
+# hpctcluster/fleet.py
+
+"""Run a command across many clusters (profiles) in one process.
+
+Each cluster runs in its own thread. Its output (prints and, via
+hpctcluster.lib.run(), subprocess output) is captured per thread (see
+hpctcluster.lib.set_capture()) and reported per cluster once it is
+done, so output from concurrent clusters does not interleave. Worker
+threads of a cluster's thread capture to the same buffer if started
+through hpctcluster.lib.inherit_capture().
+"""
+
+import io
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from hpctcluster.lib import install_capture, set_capture
+
+
+class ClusterResult:
+    def __init__(self, name):
+        self.name = name
+        self.returncode = None
+        self.output = ""
+        self.elapsed = None
+
+
+class Fleet:
+    """Run fn(name) for each cluster name, up to `jobs` at a time. fn
+    returns a return code (None means 0)."""
+
+    def __init__(self, names, jobs=4):
+        self.names = names
+        self.jobs = max(1, jobs)
+        self.results = {}
+        self._lock = threading.Lock()
+
+    def _run_one(self, name, fn):
+        result = ClusterResult(name)
+        buffer = io.StringIO()
+        set_capture(buffer)
+        start_time = time.time()
+        try:
+            result.returncode = fn(name) or 0
+        except SystemExit as e:
+            result.returncode = e.code if isinstance(e.code, int) else 1
+        except Exception as e:
+            traceback.print_exc()
+            print(f"error: {e}", file=sys.stderr)
+            result.returncode = 1
+        finally:
+            result.elapsed = time.time() - start_time
+            result.output = buffer.getvalue()
+            set_capture(None)
+        return result
+
+    def _report(self, result):
+        state = "ok" if result.returncode == 0 else f"failed ({result.returncode})"
+        with self._lock:
+            print(f"""===== {result.name}: {state} ({result.elapsed:.1f}s) =====""")
+            sys.stdout.write(result.output)
+            if result.output and not result.output.endswith("\n"):
+                print()
+            print(flush=True)
+
+    def print_summary(self):
+        print(f"""{"cluster":30} {"result":12} {"time":>8}""")
+        for name in self.names:
+            result = self.results.get(name)
+            if result == None:
+                print(f"""{name:30} {"not run":12}""")
+                continue
+            state = "ok" if result.returncode == 0 else f"failed ({result.returncode})"
+            print(f"{name:30} {state:12} {result.elapsed:7.1f}s")
+
+    def run(self, fn, names=None):
+        """Run fn for names (default: all) and return the list of names
+        that failed. Output is reported per cluster as each
+        completes."""
+
+        names = self.names if names == None else names
+        install_capture()
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = [executor.submit(self._run_one, name, fn) for name in names]
+            for future in as_completed(futures):
+                result = future.result()
+                self.results[result.name] = result
+                self._report(result)
+
+        return [name for name in names if self.results[name].returncode != 0]
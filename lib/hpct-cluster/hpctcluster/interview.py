@@ -0,0 +1,198 @@
+#! /usr/bin/env python3
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+#
+# hpctcluster/interview.py
+
+"""Non-interactive interview.
+
+Evaluates an interview (interview.yaml and the files it includes) in
+process, taking answers from a dictionary instead of prompting:
+* include - path, relative to the including file (or the profile
+  directory)
+* branch - runs its interview if match_key (if any) matches
+  match_values/match_not_values; again (while it matches) if the
+  interview asked for match_key again (e.g., "add another user?")
+* question - answer for key (with parameterize, key.<value of the
+  parameterize key>); skipped if key already has a value, unless force
+  is set
+* set, update - set or add to key
+* reset - remove keys matching name_regexp
+
+Answers are keyed by dotted key (or nested); answers for a
+parameterized key may be given for the key itself (user.name.0) or
+the question key (user.name). A list answers a question that is asked
+repeatedly, one item per time. Without an answer (or with the list
+used up), the default is used, then the first of values, then the
+start of values_range. Answers are checked against type, values,
+values_range and regexp.
+"""
+
+import os.path
+import re
+
+import yaml
+
+
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+MAX_REPEATS = 100000
+
+
+def flatten(d, prefix=""):
+    """Return {dotted key: value} for nested dict."""
+
+    flat = {}
+    for k, v in d.items():
+        key = f"{prefix}{k}"
+        if isinstance(v, dict):
+            flat.update(flatten(v, f"{key}."))
+        else:
+            flat[key] = v
+    return flat
+
+
+def unflatten(flat):
+    """Return nested dict for {dotted key: value}."""
+
+    d = {}
+    for key, v in flat.items():
+        parts = key.split(".")
+        parent = d
+        for part in parts[:-1]:
+            parent = parent.setdefault(part, {})
+        parent[parts[-1]] = v
+    return d
+
+
+def _parse_range(values_range):
+    """Return (low, high) for "<n>" or "<low>-<high>"."""
+
+    low, _, high = str(values_range).partition("-")
+    return int(low), int(high or low)
+
+
+class Interview:
+    def __init__(self, path, answers=None):
+        self.path = os.path.abspath(path)
+        self.answers = flatten(answers or {})
+        self.results = {}
+        self.used = set()
+        self._counts = {}
+        self._asked = {}
+
+    def run(self):
+        """Run interview and return results (nested)."""
+
+        self._run_items(self._load(self.path), os.path.dirname(self.path))
+        return unflatten(self.results)
+
+    def unused_answers(self):
+        return sorted(set(self.answers) - self.used)
+
+    def _load(self, path):
+        with open(path) as f:
+            return yaml.load(f, Loader=YAML_LOADER) or []
+
+    def _run_items(self, items, base_dir):
+        for item in items:
+            fn = getattr(self, f"""_do_{str(item.get("kind"))}""", None)
+            if fn == None:
+                raise Exception(f"""unknown interview item kind ({item.get("kind")})""")
+            fn(item, base_dir)
+
+    def _convert(self, item, key, value):
+        try:
+            if item.get("type") == "int":
+                return int(value)
+            if item.get("type") == "float":
+                return float(value)
+            return "" if value == None else str(value)
+        except:
+            raise Exception(f"""bad answer for ({key}): {value} ({item.get("type")} expected)""")
+
+    def _check(self, item, key, value):
+        if "values" in item and str(value) not in [str(v) for v in item["values"]]:
+            raise Exception(
+                f"""bad answer for ({key}): {value} (expected one of {item["values"]})"""
+            )
+        if "values_range" in item:
+            low, high = _parse_range(item["values_range"])
+            if not low <= value <= high:
+                raise Exception(f"bad answer for ({key}): {value} (expected {low}-{high})")
+        if "regexp" in item and not re.match(item["regexp"], str(value)):
+            raise Exception(f"""bad answer for ({key}): {value} (expected {item["regexp"]})""")
+
+    def _answer(self, item, key):
+        for k in [key, item["key"]]:
+            if k in self.answers:
+                self.used.add(k)
+                value = self.answers[k]
+                if not isinstance(value, list):
+                    return value
+                i = self._counts.get(k, 0)
+                self._counts[k] = i + 1
+                if i < len(value):
+                    return value[i]
+                break
+
+        if "default" in item:
+            return item["default"]
+        if item.get("values"):
+            return item["values"][0]
+        if "values_range" in item:
+            return _parse_range(item["values_range"])[0]
+        raise Exception(f"no answer for ({key})")
+
+    def _matches(self, item):
+        key = item.get("match_key")
+        if key == None:
+            return True
+        value = str(self.results.get(key))
+        if "match_values" in item and value not in [str(v) for v in item["match_values"]]:
+            return False
+        return value not in [str(v) for v in item.get("match_not_values", [])]
+
+    def _do_branch(self, item, base_dir):
+        key = item.get("match_key")
+        for _ in range(MAX_REPEATS):
+            if not self._matches(item):
+                return
+            asked = self._asked.get(key, 0)
+            self._run_items(item.get("interview") or [], base_dir)
+            if key == None or self._asked.get(key, 0) == asked:
+                return
+        raise Exception(f"branch on ({key}) repeated more than {MAX_REPEATS} times")
+
+    def _do_include(self, item, base_dir):
+        # relative to the including file; or, to the profile directory
+        for d in [base_dir, os.path.dirname(os.path.dirname(self.path))]:
+            path = os.path.join(d, item["path"])
+            if os.path.exists(path):
+                self._run_items(self._load(path), os.path.dirname(path))
+                return
+        raise Exception(f"""interview include ({item["path"]}) not found""")
+
+    def _do_question(self, item, base_dir):
+        key = item["key"]
+        if item.get("parameterize"):
+            key = f"""{key}.{self.results.get(item["parameterize"])}"""
+        if key in self.results and not item.get("force"):
+            return
+
+        value = self._convert(item, key, self._answer(item, key))
+        self._check(item, key, value)
+        self.results[key] = value
+        self._asked[key] = self._asked.get(key, 0) + 1
+
+    def _do_reset(self, item, base_dir):
+        regexp = re.compile(item["name_regexp"])
+        for key in list(self.results):
+            if regexp.fullmatch(key):
+                del self.results[key]
+
+    def _do_set(self, item, base_dir):
+        self.results[item["key"]] = self._convert(item, item["key"], item.get("value"))
+
+    def _do_update(self, item, base_dir):
+        key = item["key"]
+        self.results[key] = self.results.get(key, 0) + self._convert(item, key, item.get("value"))
@@ -4,37 +4,320 @@
 #
 # hpctcluster/juju.py
 
-"""Temporary front-end to juju.
+"""Front-end to juju.
 
-Future: Transition to python-libjuju.
+Operations go through a backend: the juju CLI ("cli", default), or a
+persistent API connection using python-libjuju ("api", see
+hpctcluster.jujuapi), which falls back to the CLI when unavailable.
 """
 
 import json
 import os
 import os.path
+import pwd
+import re
 import subprocess
+import tempfile
+import threading
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
-from hpctcluster.lib import run, run_capture
+import yaml
+
+from hpctcluster.lib import inherit_capture, run, run_capture
+from hpctcluster.trace import inherit_phase
 
 
 JUJU_EXEC = "/snap/bin/juju"
+SNAPSHOT_TIMEOUT = 30
+# default for readiness probes (juju.ready-timeout in the profile)
+READY_TIMEOUT = 10
+REMOVE_WORKERS = 4
+REMOVE_WAIT_INTERVAL = 5
+ACTION_TIMEOUT = 600
+# beyond the action's own (--wait) timeout, before juju itself is
+# given up on
+ACTION_TIMEOUT_MARGIN = 60
+WATCH_INTERVAL = 5
+
+# readiness (see Juju.controller_readiness())
+READY = "ready"
+NOT_READY = "not ready"
+NOT_LOGGED_IN = "not logged in"
+UNREACHABLE = "unreachable"
+
+# juju errors (stderr) meaning the controller answered, but the client
+# is not (or no longer) logged in or allowed
+_AUTH_ERRORS = re.compile(
+    r"not logged in|permission denied|unauthorized|enter password|no credentials|login",
+    re.IGNORECASE,
+)
+
+# juju login/logout update the local client files (accounts.yaml)
+_login_lock = threading.Lock()
+
+# api backends (connections, event loop thread), shared per controller
+_api_backends = {}
+_api_backends_lock = threading.Lock()
+
+
+class JujuSnapshot:
+    """Point-in-time view of controllers, users, whoami and controller
+    and model readiness. Readiness is derived from it without further
+    calls to juju."""
+
+    def __init__(
+        self,
+        controller,
+        controllers=None,
+        users=None,
+        whoami=None,
+        controller_state=None,
+        model_state=None,
+    ):
+        self.controller = controller
+        self.controllers = controllers or {}
+        self.users = users or []
+        self.whoami = whoami or {}
+        self.controller_state = controller_state or NOT_READY
+        self.model_state = model_state or NOT_READY
+
+    def as_dict(self):
+        return {
+            "controllers": self.controllers,
+            "users": self.users,
+            "whoami": self.whoami,
+            "controller_state": self.controller_state,
+            "model_state": self.model_state,
+        }
+
+    def is_controller_ready(self):
+        return self.controller_state == READY
+
+    def is_model_ready(self):
+        return self.model_state == READY
+
+    def is_ready(self):
+        return bool(self.whoami.get("controller"))
+
+    def is_user_ready(self, username):
+        for d in self.users:
+            if d.get("user-name") == username:
+                return True
+        return False
+
+
+class CliBackend:
+    """Run operations through the juju CLI."""
+
+    name = "cli"
+
+    def __init__(self, controller):
+        self.controller = controller
+        self._version = None
+
+    def add_unit(self, model, appname, count=1):
+        cp = run(
+            [JUJU_EXEC, "add-unit", appname, "-m", self._model(model), "-n", str(count)],
+            text=True,
+            decorate=True,
+        )
+        return cp.returncode
+
+    def add_user(self, username):
+        cp = run(
+            [JUJU_EXEC, "add-user", username, "-c", self.controller], text=True, decorate=True
+        )
+        return cp.returncode
+
+    def close(self):
+        pass
+
+    def _model(self, model):
+        # controller-qualified, so that the current controller does not
+        # matter
+        return f"{self.controller}:{model}"
+
+    def deploy(self, model, charmpath, *args):
+        cp = run(
+            [JUJU_EXEC, "deploy", charmpath, "-m", self._model(model), *args],
+            text=True,
+            decorate=True,
+        )
+        return cp.returncode
+
+    def grant(self, username, rights, model):
+        cp = run(
+            [JUJU_EXEC, "grant", username, rights, model, "-c", self.controller],
+            text=True,
+            decorate=True,
+        )
+        return cp.returncode
+
+    def refresh(self, model, appname, charmpath):
+        cp = run(
+            [JUJU_EXEC, "refresh", appname, "-m", self._model(model), "--path", charmpath],
+            text=True,
+            decorate=True,
+        )
+        return cp.returncode
+
+    def relate(self, model, endpoint1, endpoint2):
+        cp = run(
+            [JUJU_EXEC, "relate", "-m", self._model(model), endpoint1, endpoint2],
+            text=True,
+            decorate=True,
+        )
+        return cp.returncode
+
+    def remove_relation(self, model, endpoint1, endpoint2):
+        cp = run(
+            [JUJU_EXEC, "remove-relation", "-m", self._model(model), endpoint1, endpoint2],
+            text=True,
+            decorate=True,
+        )
+        return cp.returncode
+
+    def remove_unit(self, model, unitnames):
+        cp = run(
+            [JUJU_EXEC, "remove-unit", "-m", self._model(model), *unitnames],
+            text=True,
+            decorate=True,
+        )
+        return cp.returncode
+
+    def remove_application(self, model, appname, force=False):
+        # waiting is left to the caller (see Juju.remove_applications)
+        sargs = [JUJU_EXEC, "remove-application", appname, "-m", self._model(model)]
+        if force:
+            sargs.append("--force")
+        cp = run_capture(sargs, text=True)
+        if cp.returncode != 0:
+            print(f"error: failed to remove application ({appname}): {cp.stderr.strip()}")
+        return cp.returncode
+
+    def status(self, model, timeout=None):
+        try:
+            cp = run_capture(
+                [JUJU_EXEC, "status", "-m", self._model(model), "--format", "json"],
+                text=True,
+                timeout=timeout,
+            )
+        except subprocess.TimeoutExpired:
+            return None
+        if cp.returncode != 0:
+            return None
+        return json.loads(cp.stdout)
+
+    def run_action(self, model, unitname, action, params, timeout=ACTION_TIMEOUT):
+        # "juju run" runs actions since juju 3; "run-action" before
+        sargs = ["run"] if self.version() >= (3,) else ["run-action"]
+        with tempfile.NamedTemporaryFile("wt", prefix="hpct-params-", suffix=".json") as f:
+            # params go in a file: they may be too large for the command line
+            json.dump(params, f)
+            f.flush()
+            try:
+                cp = run_capture(
+                    [
+                        JUJU_EXEC,
+                        *sargs,
+                        "-m",
+                        self._model(model),
+                        unitname,
+                        action,
+                        "--params",
+                        f.name,
+                        "--format",
+                        "json",
+                        f"--wait={timeout}s",
+                    ],
+                    text=True,
+                    timeout=timeout + ACTION_TIMEOUT_MARGIN,
+                )
+            except subprocess.TimeoutExpired:
+                return 1, {"message": "timed out"}
+
+        try:
+            # keyed by unit; one unit here
+            d = list(json.loads(cp.stdout).values())[0]
+        except:
+            return 1, {"message": cp.stderr.strip() or "no result"}
+        results = d.get("results") or {}
+        return (0 if d.get("status") == "completed" else 1), results
+
+    def users(self, timeout=None):
+        try:
+            cp = run_capture(
+                [JUJU_EXEC, "users", "-c", self.controller, "--format", "json"],
+                text=True,
+                timeout=timeout,
+            )
+        except subprocess.TimeoutExpired:
+            return None
+        if cp.returncode != 0:
+            return None
+        return json.loads(cp.stdout)
+
+    def version(self):
+        """Return juju (client) version as a tuple of ints."""
+
+        if self._version == None:
+            cp = run_capture([JUJU_EXEC, "version"], text=True)
+            m = re.match(r"(\d+)\.(\d+)", cp.stdout.strip())
+            self._version = (int(m.group(1)), int(m.group(2))) if m else (0, 0)
+        return self._version
+
+    def watch(self, model, interval=WATCH_INTERVAL):
+        """Yield status snapshots (polled; the CLI has no delta
+        stream)."""
+
+        while True:
+            yield self.status(model, timeout=SNAPSHOT_TIMEOUT)
+            time.sleep(interval)
+
+
+def get_backend(name, controller):
+    """Return backend by name ("cli", "api" or "auto"). api backends
+    are shared by all Juju objects for the same controller."""
+
+    name = name or "cli"
+    if name in ["api", "auto"]:
+        try:
+            from hpctcluster.jujuapi import ApiBackend
+
+            with _api_backends_lock:
+                if controller not in _api_backends:
+                    _api_backends[controller] = ApiBackend(controller, CliBackend(controller))
+                return _api_backends[controller]
+        except Exception as e:
+            if name == "api":
+                print(f"warning: juju api backend not available ({e}); using cli")
+    elif name != "cli":
+        raise Exception(f"unknown juju backend ({name})")
+    return CliBackend(controller)
 
 
 class Juju:
-    def __init__(self, cloud, controller, model="admin/default"):
+    def __init__(
+        self, cloud, controller, model="admin/default", backend=None, ready_timeout=None
+    ):
         self.cloud = cloud
         self.controller = controller
         self.model = model
+        self.backend = get_backend(backend, controller)
+        self.ready_timeout = ready_timeout or READY_TIMEOUT
 
     def add_model(self, model=None, *args):
         model = model or self.model
         cp = run([JUJU_EXEC, "add-model", model], text=True, decorate=True)
         return cp.returncode
 
+    def add_unit(self, appname, count=1):
+        return self.backend.add_unit(self._qualified_model(), appname, count)
+
     def add_user(self, username):
-        cp = run([JUJU_EXEC, "add-user", username], text=True, decorate=True)
-        return cp.returncode
+        return self.backend.add_user(username)
 
     def bootstrap(self):
         print(
@@ -51,8 +334,17 @@ class Juju:
             print("juju bootstrap failed")
             raise Exception()
 
+    def _as_user(self, os_username):
+        """Return command prefix and environment to run juju as another
+        (OS) user, with that user's juju data."""
+
+        home = pwd.getpwnam(os_username).pw_dir
+        env = dict(os.environ, HOME=home, USER=os_username, LOGNAME=os_username)
+        env.pop("JUJU_DATA", None)
+        return ["runuser", "-u", os_username, "--"], env
+
     def check_user(self, username):
-        cp = run_capture([JUJU_EXEC, "show-user", username], text=True)
+        cp = run_capture([JUJU_EXEC, "show-user", username, "-c", self.controller], text=True)
         return cp.returncode
 
     def controllers(self):
@@ -62,78 +354,261 @@ class Juju:
         d = json.loads(cp.stdout)
         return d
 
+    def controller_readiness(self, timeout=None):
+        """Return READY, NOT_READY (no controller or account known
+        locally), NOT_LOGGED_IN (answering, but refusing the account)
+        or UNREACHABLE (known, but not answering within timeout,
+        default: ready_timeout).
+
+        The local controllers.yaml/accounts.yaml are checked first;
+        only then is the controller contacted (once)."""
+
+        if not os.path.exists(JUJU_EXEC):
+            return NOT_READY
+        for name in ["controllers", "accounts"]:
+            d = self._load_juju_data(f"{name}.yaml")
+            if self.controller not in (d.get("controllers") or {}):
+                return NOT_READY
+
+        return self._ping([JUJU_EXEC, "show-controller", self.controller], timeout)
+
+    def _qualified_model(self):
+        # TODO: why is the short model name not good enough?
+        return self.model if "/" in self.model else f"admin/{self.model}"
+
+    def close(self):
+        # backends may be shared (api, per controller); they are closed
+        # at exit
+        pass
+
     def deploy(self, charmpath, *args):
-        model = self.model if "/" in self.model else f"admin/{self.model}"
-        cp = run([JUJU_EXEC, "deploy", charmpath, "-m", model, *args], text=True, decorate=True)
-        return cp.returncode
+        return self.backend.deploy(self._qualified_model(), charmpath, *args)
+
+    def get_register_token(self, username, reset=False):
+        """Add user (or, with reset, reset the password of the existing
+        user) and return the "juju register" token, or None."""
+
+        if reset:
+            print(f"resetting password of existing user ({username}) ...")
+            cmdargs = [JUJU_EXEC, "change-user-password", username, "--reset"]
+        else:
+            cmdargs = [JUJU_EXEC, "add-user", username]
+        cmdargs.extend(["-c", self.controller])
+        cp = run_capture(cmdargs, text=True)
+        if cp.returncode != 0:
+            print(f"error: cannot get registration token ({cp.stderr.strip()})")
+            return None
+
+        m = re.search(r"juju register (\S+)", cp.stdout)
+        return m.group(1) if m else None
 
     def grant(self, username, rights, model):
-        cp = run([JUJU_EXEC, "grant", username, rights, model], text=True, decorate=True)
-        return cp.returncode
+        return self.backend.grant(username, rights, model)
 
     def is_controller_ready(self):
-        cp = run_capture([JUJU_EXEC, "controllers", "--format", "json"], text=True)
-        if cp.returncode == 0:
-            d = json.loads(cp.stdout)
-            if d.get("controllers", {}).get(self.controller):
-                return True
-        return False
+        d = self._load_juju_data("controllers.yaml")
+        return self.controller in (d.get("controllers") or {})
 
     def is_model_ready(self):
-        # TODO: why is the short model name not good enough?
-        model = self.model if "/" in self.model else f"admin/{self.model}"
-
-        cp = run_capture([JUJU_EXEC, "status", "-m", model], text=True)
-        return True if not cp.returncode else False
+        return self.model_readiness() == READY
 
     def is_ready(self):
-        try:
-            if not os.path.exists(JUJU_EXEC):
-                return False
-
-            cp = run_capture([JUJU_EXEC, "status"], text=True, timeout=5)
-            return True if not cp.returncode else False
-        except:
-            print("warning: ensure you are logged into juju")
-            return False
+        state = self.controller_readiness()
+        if state == NOT_LOGGED_IN:
+            print(f"warning: not logged in to controller ({self.controller})")
+        elif state == UNREACHABLE:
+            print(f"warning: controller ({self.controller}) unreachable")
+        return state == READY
 
     def is_user_ready(self, username):
-        cp = run_capture([JUJU_EXEC, "users", "--format", "json"], text=True)
-        if cp.returncode == 0:
-            l = json.loads(cp.stdout)
-            for d in l:
-                if d.get("user-name") == username:
-                    return True
+        for d in self.backend.users() or []:
+            if d.get("user-name") == username:
+                return True
         return False
 
-    def login_user(self, username):
-        cp = run([JUJU_EXEC, "login", "-u", username], text=True, decorate=True)
+    def _load_juju_data(self, filename):
+        """Load (local) juju client file; {} if missing or bad."""
+
+        juju_data = os.environ.get("JUJU_DATA") or os.path.expanduser("~/.local/share/juju")
+        try:
+            return yaml.safe_load(open(f"{juju_data}/{filename}").read()) or {}
+        except:
+            return {}
+
+    def account_user(self):
+        """Return user logged in to the controller (from the local
+        accounts.yaml), or ""."""
+
+        d = self._load_juju_data("accounts.yaml")
+        return ((d.get("controllers") or {}).get(self.controller) or {}).get("user", "")
+
+    def login_user(self, username, prompt=True):
+        # without prompt, a login that needs a password fails instead
+        kwargs = {} if prompt else {"stdin": subprocess.DEVNULL}
+        with _login_lock:
+            cp = run(
+                [JUJU_EXEC, "login", "-u", username, "-c", self.controller],
+                text=True,
+                decorate=True,
+                **kwargs,
+            )
         return cp.returncode
 
     def logout_user(self):
-        cp = run([JUJU_EXEC, "logout"], text=True, decorate=True)
+        with _login_lock:
+            cp = run([JUJU_EXEC, "logout", "-c", self.controller], text=True, decorate=True)
         return cp.returncode
 
+    def model_readiness(self, timeout=None):
+        """Return READY, NOT_READY, NOT_LOGGED_IN or UNREACHABLE for the
+        model (see controller_readiness()), without getting the model
+        status."""
+
+        model = f"{self.controller}:{self._qualified_model()}"
+        return self._ping([JUJU_EXEC, "show-model", model, "--format", "json"], timeout)
+
+    def _ping(self, cmdargs, timeout):
+        try:
+            # no stdin: juju must not prompt for a password here
+            cp = run_capture(
+                cmdargs, text=True, timeout=timeout or self.ready_timeout, stdin=subprocess.DEVNULL
+            )
+        except subprocess.TimeoutExpired:
+            return UNREACHABLE
+        if cp.returncode == 0:
+            return READY
+        if "not found" in cp.stderr:
+            return NOT_READY
+        if _AUTH_ERRORS.search(cp.stderr):
+            return NOT_LOGGED_IN
+        return UNREACHABLE
+
+    def refresh(self, appname, charmpath):
+        return self.backend.refresh(self._qualified_model(), appname, charmpath)
+
+    def relate(self, endpoint1, endpoint2):
+        return self.backend.relate(self._qualified_model(), endpoint1, endpoint2)
+
     def remove_application(self, appname, force=False):
-        sargs = [JUJU_EXEC, "remove_application", appname, "--wait"]
-        if force:
-            sargs.append("--force")
-        cp = run(sargs, text=True, decorate=True)
-        return cp.returncode
+        return self.backend.remove_application(self._qualified_model(), appname, force)
+
+    def remove_applications(
+        self, appnames, force=False, subordinates=None, max_workers=REMOVE_WORKERS, timeout=None
+    ):
+        """Remove applications, subordinates first, issuing the removals
+        of each group concurrently. Then wait for all of them with one
+        status watch, reporting per-application teardown time.
+
+        Return the number of applications not removed."""
+
+        status = self.status(timeout=SNAPSHOT_TIMEOUT)
+        if status == None:
+            print("error: cannot get model status")
+            return len(appnames)
+
+        present = [name for name in appnames if name in status.get("applications", {})]
+        subordinates = subordinates or []
+        tiers = [
+            [name for name in present if name in subordinates],
+            [name for name in present if name not in subordinates],
+        ]
+
+        start_time = time.time()
+        failed = []
+        for tier in filter(None, tiers):
+            print(f"""removing applications ({" ".join(tier)}) ...""")
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                remove = inherit_phase(
+                    inherit_capture(lambda name: self.remove_application(name, force))
+                )
+                rvs = list(executor.map(remove, tier))
+            failed.extend([name for name, rv in zip(tier, rvs) if rv != 0])
+
+        # one watch for everything
+        pending = [name for name in present if name not in failed]
+        removed = {}
+        while pending:
+            if timeout != None and time.time() - start_time > timeout:
+                print(f"""error: timed out waiting for removal ({" ".join(pending)})""")
+                break
+            time.sleep(REMOVE_WAIT_INTERVAL)
+
+            status = self.status(timeout=SNAPSHOT_TIMEOUT)
+            if status == None:
+                continue
+            applications = status.get("applications", {})
+            for name in pending[:]:
+                if name not in applications:
+                    removed[name] = time.time() - start_time
+                    pending.remove(name)
+                    print(f"{name}: removed ({removed[name]:.1f}s)")
+
+        print()
+        print(f"""{"application":40} {"teardown":>10}""")
+        for name in present:
+            if name in removed:
+                print(f"{name:40} {removed[name]:9.1f}s")
+            else:
+                print(f"""{name:40} {"failed" if name in failed else "pending":>10}""")
+
+        return len(present) - len(removed)
+
+    def remove_relation(self, endpoint1, endpoint2):
+        return self.backend.remove_relation(self._qualified_model(), endpoint1, endpoint2)
+
+    def remove_unit(self, unitnames):
+        return self.backend.remove_unit(self._qualified_model(), unitnames)
+
+    def register_user(self, os_username, token, password):
+        """Register (headless) as OS user with a "juju register" token,
+        switch to the model and return the resulting whoami (or {})."""
 
-    def remove_applications(self, appnames, force=False):
-        for appname in appnames:
-            rv = self.remove_application(appname, force)
+        prefix, env = self._as_user(os_username)
+
+        # prompts: new password, confirm password, controller name
+        cp = run(
+            [*prefix, JUJU_EXEC, "register", "--replace", token],
+            input=f"{password}\n{password}\n{self.controller}\n",
+            env=env,
+            text=True,
+            decorate=True,
+        )
+        if cp.returncode != 0:
+            return {}
+
+        model = f"{self.controller}:{self._qualified_model()}"
+        cp = run([*prefix, JUJU_EXEC, "switch", model], env=env, text=True, decorate=True)
+        if cp.returncode != 0:
+            return {}
+
+        cp = run_capture([*prefix, JUJU_EXEC, "whoami", "--format", "json"], env=env, text=True)
+        if cp.returncode != 0:
+            return {}
+        return json.loads(cp.stdout)
 
     def setup(self):
         """Set up juju, itself."""
 
         print("checking for controller ...")
-        if not self.is_ready():
+        state = self.controller_readiness()
+        if state == NOT_LOGGED_IN:
+            print(f"not logged in to controller ({self.controller})")
+            return 1
+        elif state == UNREACHABLE:
+            print(f"controller ({self.controller}) unreachable")
+            return 1
+        elif state == NOT_READY:
             self.bootstrap()
 
         print("checking model ...")
-        if not self.is_model_ready():
+        state = self.model_readiness()
+        if state == NOT_LOGGED_IN:
+            print(f"not allowed to access model ({self.model})")
+            return 1
+        elif state == UNREACHABLE:
+            print(f"model ({self.model}) unreachable")
+            return 1
+        elif state == NOT_READY:
             rv = self.add_model(self.model)
             if rv == 0:
                 print(f"model ({self.model}) added")
@@ -179,8 +654,65 @@ class Juju:
                 print(f"model ({self.model}) not added")
                 return 1
 
+    def snapshot(self):
+        """Take a snapshot of juju state. Local probes run first; the
+        controller is contacted (with bounded time) only if it is known
+        and answers, with the remaining probes run concurrently."""
+
+        if not os.path.exists(JUJU_EXEC):
+            return JujuSnapshot(self.controller)
+
+        controller_state = self.controller_readiness()
+        probes = {
+            "controllers": self.controllers,
+            "whoami": self.whoami,
+        }
+        if controller_state == READY:
+            probes["users"] = lambda: self.backend.users(timeout=self.ready_timeout)
+            probes["model_state"] = self.model_readiness
+
+        def probe(item):
+            name, fn = item
+            try:
+                return name, fn()
+            except:
+                return name, None
+
+        with ThreadPoolExecutor(max_workers=len(probes)) as executor:
+            results = dict(executor.map(probe, probes.items()))
+        return JujuSnapshot(self.controller, controller_state=controller_state, **results)
+
+    def run_action(self, unitname, action, params, timeout=ACTION_TIMEOUT):
+        """Run action on unit (e.g., "ldap-server/leader") and wait for
+        it. Return (returncode, results)."""
+
+        return self.backend.run_action(self._qualified_model(), unitname, action, params, timeout)
+
+    def status(self, timeout=None):
+        """Return model status (in "juju status --format json" form)."""
+
+        return self.backend.status(self._qualified_model(), timeout=timeout)
+
+    def watch(self, interval=WATCH_INTERVAL):
+        """Yield model status snapshots as the model changes (or every
+        interval, at most)."""
+
+        return self.backend.watch(self._qualified_model(), interval)
+
     def whoami(self):
-        cp = run_capture([JUJU_EXEC, "whoami", "--format", "json"], text=True)
-        if cp.returncode != 0 or cp.stderr != "":
+        """Return "juju whoami"-like information for this controller
+        (rather than the current one), or {} if not logged in to it.
+
+        "juju whoami" has no controller option; the local
+        accounts.yaml/models.yaml are read instead."""
+
+        user = self.account_user()
+        if not user:
             return {}
-        return json.loads(cp.stdout)
+        d = self._load_juju_data("models.yaml")
+        models = (d.get("controllers") or {}).get(self.controller) or {}
+        return {
+            "controller": self.controller,
+            "model": models.get("current-model", ""),
+            "user": user,
+        }
@@ -0,0 +1,361 @@
+#! /usr/bin/env python3
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+#
+# hpctcluster/jujuapi.py
+
+"""Juju API backend (python-libjuju).
+
+One authenticated websocket connection is kept per controller (and per
+model) for the life of the process, instead of paying the juju CLI
+startup and a fresh controller connection on every call. libjuju is
+asyncio-based; its event loop runs in a background thread so the
+backend can be called like the CLI backend.
+
+If a connection cannot be made, the backend falls back to the CLI
+backend for the rest of the process.
+"""
+
+import asyncio
+import atexit
+import threading
+
+from juju.controller import Controller
+from juju.model import Model
+
+
+CONNECT_TIMEOUT = 60
+WATCH_INTERVAL = 5
+
+
+def _current(status):
+    return {"current": getattr(status, "status", None), "message": getattr(status, "info", "")}
+
+
+def _unit_to_dict(unit):
+    return {
+        "workload-status": _current(getattr(unit, "workload_status", None)),
+        "juju-status": _current(getattr(unit, "agent_status", None)),
+        "machine": getattr(unit, "machine", None),
+        "subordinates": {
+            name: _unit_to_dict(sub)
+            for name, sub in (getattr(unit, "subordinates", None) or {}).items()
+        },
+    }
+
+
+def status_to_dict(status):
+    """Convert FullStatus to "juju status --format json" form (the
+    parts used by hpct-cluster)."""
+
+    applications = {}
+    for name, app in (status.applications or {}).items():
+        applications[name] = {
+            "application-status": _current(getattr(app, "status", None)),
+            "charm": getattr(app, "charm", None),
+            "relations": dict(getattr(app, "relations", None) or {}),
+            "units": {
+                uname: _unit_to_dict(unit)
+                for uname, unit in (getattr(app, "units", None) or {}).items()
+            },
+        }
+        if getattr(app, "subordinate_to", None):
+            applications[name]["subordinate-to"] = list(app.subordinate_to)
+
+    machines = {}
+    for name, machine in (status.machines or {}).items():
+        machines[name] = {
+            "juju-status": _current(getattr(machine, "agent_status", None)),
+            "machine-status": _current(getattr(machine, "instance_status", None)),
+            "hardware": getattr(machine, "hardware", ""),
+        }
+
+    return {"applications": applications, "machines": machines}
+
+
+def model_to_dict(model):
+    """Convert the state libjuju keeps for a connected model (updated
+    by its all-watcher) to "juju status --format json" form."""
+
+    applications = {}
+    for name, app in model.applications.items():
+        applications[name] = {
+            "application-status": {"current": app.status},
+            "relations": {},
+            "units": {
+                unit.name: {
+                    "workload-status": {
+                        "current": unit.workload_status,
+                        "message": unit.workload_status_message,
+                    },
+                    "juju-status": {"current": unit.agent_status},
+                    "machine": getattr(unit, "machine_id", None),
+                }
+                for unit in app.units
+            },
+        }
+
+    for relation in model.relations:
+        endpoints = relation.endpoints
+        for endpoint in endpoints:
+            app = applications.get(endpoint.application_name)
+            if app == None:
+                continue
+            # peer relations have a single endpoint
+            remotes = [e.application_name for e in endpoints if e is not endpoint]
+            remotes = remotes or [endpoint.application_name]
+            app["relations"].setdefault(endpoint.name, []).extend(remotes)
+
+    machines = {
+        name: {"juju-status": {"current": machine.agent_status}}
+        for name, machine in model.machines.items()
+    }
+
+    return {"applications": applications, "machines": machines}
+
+
+class ApiBackend:
+    """Run operations through persistent juju API connections."""
+
+    name = "api"
+
+    def __init__(self, controller, fallback):
+        self.controller_name = controller
+        self.fallback = fallback
+
+        self._controller = None
+        self._models = {}
+        self._connect_lock = None
+        self._failed = False
+        self._lock = threading.Lock()
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def _call(self, fn, error_value, *args, **kwargs):
+        """Run coroutine function on the backend loop, falling back to
+        the CLI backend if the API cannot be reached."""
+
+        if not self._failed:
+            try:
+                return asyncio.run_coroutine_threadsafe(
+                    getattr(self, f"_{fn}")(*args, **kwargs), self.loop
+                ).result()
+            except ConnectionError as e:
+                with self._lock:
+                    if not self._failed:
+                        print(f"warning: juju api connection failed ({e}); using cli")
+                    self._failed = True
+            except Exception as e:
+                print(f"error: juju {fn} failed ({e})")
+                return error_value
+
+        return getattr(self.fallback, fn)(*args, **kwargs)
+
+    def _get_connect_lock(self):
+        # created on first use, from within the backend loop
+        if self._connect_lock == None:
+            self._connect_lock = asyncio.Lock()
+        return self._connect_lock
+
+    async def _connect(self, obj, *args):
+        try:
+            await asyncio.wait_for(obj.connect(*args), CONNECT_TIMEOUT)
+        except Exception as e:
+            raise ConnectionError(str(e) or e.__class__.__name__)
+        return obj
+
+    async def _get_controller(self):
+        async with self._get_connect_lock():
+            if self._controller == None:
+                self._controller = await self._connect(Controller(), self.controller_name)
+        return self._controller
+
+    async def _get_model(self, model):
+        async with self._get_connect_lock():
+            if model not in self._models:
+                self._models[model] = await self._connect(
+                    Model(), f"{self.controller_name}:{model}"
+                )
+        return self._models[model]
+
+    async def _add_unit(self, model, appname, count=1):
+        m = await self._get_model(model)
+        await m.applications[appname].add_unit(count=count)
+        return 0
+
+    async def _close(self):
+        for m in self._models.values():
+            await m.disconnect()
+        if self._controller != None:
+            await self._controller.disconnect()
+        self._models = {}
+        self._controller = None
+
+    async def _deploy(self, model, charmpath, *args):
+        m = await self._get_model(model)
+        await m.deploy(charmpath)
+        return 0
+
+    async def _grant(self, username, rights, model):
+        controller = await self._get_controller()
+        uuids = await controller.model_uuids()
+        uuid = uuids.get(model.split("/")[-1])
+        if uuid == None:
+            print(f"error: model ({model}) not found")
+            return 1
+        await controller.grant_model(username, uuid, rights)
+        return 0
+
+    async def _remove_observer(self, model, callable_):
+        # libjuju has no public way to remove an observer
+        m = await self._get_model(model)
+        for observer, fn in list(m._observers.items()):
+            if fn is callable_:
+                del m._observers[observer]
+
+    async def _relate(self, model, endpoint1, endpoint2):
+        m = await self._get_model(model)
+        await m.relate(endpoint1, endpoint2)
+        return 0
+
+    async def _remove_relation(self, model, endpoint1, endpoint2):
+        m = await self._get_model(model)
+        appname, endpoint = endpoint1.split(":")
+        await m.applications[appname].remove_relation(endpoint, endpoint2)
+        return 0
+
+    async def _remove_unit(self, model, unitnames):
+        m = await self._get_model(model)
+        await m.destroy_units(*unitnames)
+        return 0
+
+    async def _remove_application(self, model, appname, force=False):
+        # waiting is left to the caller (see Juju.remove_applications)
+        m = await self._get_model(model)
+        await m.remove_application(appname, force=force)
+        return 0
+
+    async def _run_action(self, model, unitname, action, params, timeout):
+        m = await self._get_model(model)
+        appname, unitid = unitname.split("/")
+        units = m.applications[appname].units
+        if unitid == "leader":
+            units = [unit for unit in units if await unit.is_leader_from_status()]
+        else:
+            units = [unit for unit in units if unit.name == unitname]
+        if not units:
+            return 1, {"message": f"unit ({unitname}) not found"}
+
+        a = await units[0].run_action(action, **params)
+        a = await asyncio.wait_for(a.wait(), timeout)
+        return (0 if a.status == "completed" else 1), a.results or {}
+
+    async def _status(self, model, timeout=None):
+        m = await self._get_model(model)
+        status = await asyncio.wait_for(m.get_status(), timeout)
+        return status_to_dict(status)
+
+    async def _users(self, timeout=None):
+        controller = await self._get_controller()
+        users = await asyncio.wait_for(controller.get_users(), timeout)
+        return [
+            {
+                "user-name": user.username,
+                "display-name": user.display_name,
+                "access": user.access,
+            }
+            for user in users
+        ]
+
+    async def _snapshot(self, model):
+        m = await self._get_model(model)
+        return model_to_dict(m)
+
+    def add_unit(self, model, appname, count=1):
+        return self._call("add_unit", 1, model, appname, count)
+
+    def add_user(self, username):
+        # the registration token is only reported by the CLI
+        return self.fallback.add_user(username)
+
+    def close(self):
+        if self.loop.is_running():
+            try:
+                asyncio.run_coroutine_threadsafe(self._close(), self.loop).result(10)
+            except:
+                pass
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def deploy(self, model, charmpath, *args):
+        if args:
+            # extra CLI options have no API equivalent here
+            return self.fallback.deploy(model, charmpath, *args)
+        return self._call("deploy", 1, model, charmpath)
+
+    def grant(self, username, rights, model):
+        return self._call("grant", 1, username, rights, model)
+
+    def refresh(self, model, appname, charmpath):
+        # local charm upload is left to the CLI
+        return self.fallback.refresh(model, appname, charmpath)
+
+    def relate(self, model, endpoint1, endpoint2):
+        return self._call("relate", 1, model, endpoint1, endpoint2)
+
+    def remove_relation(self, model, endpoint1, endpoint2):
+        return self._call("remove_relation", 1, model, endpoint1, endpoint2)
+
+    def remove_unit(self, model, unitnames):
+        return self._call("remove_unit", 1, model, unitnames)
+
+    def remove_application(self, model, appname, force=False):
+        return self._call("remove_application", 1, model, appname, force)
+
+    def run_action(self, model, unitname, action, params, timeout):
+        return self._call(
+            "run_action", (1, {"message": "failed"}), model, unitname, action, params, timeout
+        )
+
+    def status(self, model, timeout=None):
+        return self._call("status", None, model, timeout=timeout)
+
+    def users(self, timeout=None):
+        return self._call("users", None, timeout=timeout)
+
+    def watch(self, model, interval=WATCH_INTERVAL):
+        """Yield status snapshots each time the model's all-watcher
+        reports a change (or every interval, at most)."""
+
+        if self._failed:
+            yield from self.fallback.watch(model, interval)
+            return
+
+        changed = threading.Event()
+
+        async def on_change(delta, old, new, model):
+            changed.set()
+
+        try:
+            m = asyncio.run_coroutine_threadsafe(self._get_model(model), self.loop).result()
+            m.add_observer(on_change)
+        except ConnectionError as e:
+            print(f"warning: juju api connection failed ({e}); using cli")
+            self._failed = True
+            yield from self.fallback.watch(model, interval)
+            return
+
+        try:
+            while True:
+                changed.clear()
+                yield asyncio.run_coroutine_threadsafe(self._snapshot(model), self.loop).result()
+                changed.wait(interval)
+        finally:
+            try:
+                asyncio.run_coroutine_threadsafe(
+                    self._remove_observer(model, on_change), self.loop
+                ).result(10)
+            except:
+                pass
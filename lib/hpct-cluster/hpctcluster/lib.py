@@ -4,7 +4,14 @@
 #
 # hpctcluster/lib.py
 
+import functools
+import os.path
 import subprocess
+import sys
+import threading
+import time
+
+from hpctcluster import trace
 
 
 class DottedDictWrapper:
@@ -96,11 +103,262 @@ class DottedDictWrapper:
             yield v
 
 
+_MISSING = object()
+
+
+@functools.lru_cache(maxsize=4096)
+def _split_key(key, sep):
+    return tuple(key.split(sep))
+
+
+class CompiledDottedDictWrapper:
+    """Faster variant of DottedDictWrapper.
+
+    Split keys are memoized, leaf values are looked up in a flattened
+    index (rebuilt on demand after __setitem__/update through any
+    wrapper sharing the same top-level dictionary), and get() does a
+    single lookup.
+
+    Changes made directly to the wrapped dictionary are not seen until
+    invalidate() is called.
+    """
+
+    __slots__ = ("d", "sep", "_generation", "_index", "_index_generation", "_root")
+
+    def __init__(self, d=None, sep=".", _root=None):
+        self.d = d if d != None else {}
+        self.sep = sep
+        self._generation = 0
+        self._index = None
+        self._index_generation = None
+        self._root = _root if _root != None else self
+
+    def __contains__(self, key):
+        return self._lookup(key) is not _MISSING
+
+    def __getitem__(self, key):
+        v = self._lookup(key)
+        if v is _MISSING:
+            raise KeyError(key)
+        if isinstance(v, dict):
+            v = self.__class__(v, self.sep, self._root)
+        return v
+
+    def __repr__(self):
+        return str(dict(self._get_index()))
+
+    def __setitem__(self, key, value):
+        keys = _split_key(key, self.sep)
+        v = self.d
+        for k in keys[:-1]:
+            if k not in v:
+                v[k] = {}
+            v = v[k]
+            if not isinstance(v, dict):
+                # already set
+                raise KeyError(key)
+        v[keys[-1]] = value
+        self.invalidate()
+
+    def _get_index(self):
+        if self._index == None or self._index_generation != self._root._generation:
+            self._index = dict(self._walk(self.d))
+            self._index_generation = self._root._generation
+        return self._index
+
+    def _lookup(self, key):
+        v = self._get_index().get(key, _MISSING)
+        if v is not _MISSING:
+            return v
+
+        # not a leaf
+        v = self.d
+        for k in _split_key(key, self.sep):
+            if not isinstance(v, dict):
+                return _MISSING
+            v = v.get(k, _MISSING)
+            if v is _MISSING:
+                break
+        return v
+
+    def _walk(self, d, pref=None):
+        for k in d:
+            _pref = f"{pref}{self.sep}{k}" if pref else k
+            v = d[k]
+            if isinstance(v, dict):
+                yield from self._walk(v, _pref)
+            else:
+                yield (_pref, v)
+
+    def copy(self):
+        return self.__class__(self.d.copy(), self.sep)
+
+    def get(self, key, default=None):
+        v = self._lookup(key)
+        if v is _MISSING:
+            return default
+        if isinstance(v, dict):
+            v = self.__class__(v, self.sep, self._root)
+        return v
+
+    def invalidate(self):
+        """Invalidate indexes of all wrappers sharing the top-level
+        dictionary."""
+
+        self._root._generation += 1
+
+    def keys(self):
+        return iter(list(self._get_index().keys()))
+
+    def items(self):
+        return iter(list(self._get_index().items()))
+
+    def update(self, d):
+        self.d.update(d)
+        self.invalidate()
+
+    def values(self):
+        return iter(list(self._get_index().values()))
+
+
+def _traced_run(*args, **kwargs):
+    """subprocess.run(), recording a trace record when tracing is
+    enabled (see hpctcluster.trace)."""
+
+    if not trace.get_trace_path():
+        return subprocess.run(*args, **kwargs)
+
+    argv = args[0] if args else kwargs.get("args")
+    start_time = time.time()
+    cp = None
+    error = None
+    try:
+        cp = subprocess.run(*args, **kwargs)
+    except Exception as e:
+        error = f"{e.__class__.__name__}: {e}"
+        raise
+    finally:
+        trace.record(argv, kwargs.get("cwd"), start_time, time.time(), cp, error)
+    return cp
+
+
+_capture_local = threading.local()
+
+
+class _ThreadOutput:
+    """sys.stdout/sys.stderr stand-in writing to the current thread's
+    capture buffer, if any."""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def _target(self):
+        return getattr(_capture_local, "buffer", None) or self.stream
+
+    def flush(self):
+        self._target().flush()
+
+    def isatty(self):
+        return get_capture() == None and self.stream.isatty()
+
+    def write(self, s):
+        return self._target().write(s)
+
+
+def get_capture():
+    """Return capture buffer of the current thread, or None."""
+
+    return getattr(_capture_local, "buffer", None)
+
+
+def set_capture(buffer):
+    """Capture output of the current thread (prints, and subprocess
+    output via run()) to buffer; None to stop capturing."""
+
+    _capture_local.buffer = buffer
+
+
+def inherit_capture(fn):
+    """Wrap fn to run (e.g., in a worker thread) with the capture
+    buffer of the calling thread."""
+
+    buffer = get_capture()
+
+    def wrapper(*args, **kwargs):
+        previous = get_capture()
+        _capture_local.buffer = buffer
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _capture_local.buffer = previous
+
+    return wrapper
+
+
+def install_capture():
+    """Route sys.stdout/sys.stderr through the per-thread capture (see
+    set_capture()). Threads without a capture buffer write to the
+    original streams."""
+
+    if not isinstance(sys.stdout, _ThreadOutput):
+        sys.stdout = _ThreadOutput(sys.stdout)
+    if not isinstance(sys.stderr, _ThreadOutput):
+        sys.stderr = _ThreadOutput(sys.stderr)
+
+
+def get_git_commit(path):
+    """Return commit of the git checkout at path, or None. Reads .git
+    directly (no git process)."""
+
+    try:
+        git_dir = f"{path}/.git"
+        if os.path.isfile(git_dir):
+            # worktree/submodule: "gitdir: <path>"
+            git_dir = open(git_dir).read().split(":", 1)[1].strip()
+            git_dir = os.path.join(path, git_dir)
+
+        head = open(f"{git_dir}/HEAD").read().strip()
+        if not head.startswith("ref:"):
+            return head
+        ref = head.split(":", 1)[1].strip()
+
+        # refs may live in the common dir (worktrees) and be packed
+        common_dir = git_dir
+        if os.path.exists(f"{git_dir}/commondir"):
+            common_dir = os.path.join(git_dir, open(f"{git_dir}/commondir").read().strip())
+        for d in [git_dir, common_dir]:
+            if os.path.exists(f"{d}/{ref}"):
+                return open(f"{d}/{ref}").read().strip()
+        for line in open(f"{common_dir}/packed-refs"):
+            if line.rstrip().endswith(f" {ref}"):
+                return line.split()[0]
+    except:
+        pass
+    return None
+
+
 def run(*args, **kwargs):
+    # output going to the terminal is captured instead when the thread
+    # captures its output (see set_capture())
+    capture = get_capture() != None and not (
+        {"stdout", "stderr", "capture_output"} & set(kwargs)
+    )
+    if capture:
+        kwargs.update({"stdout": subprocess.PIPE, "stderr": subprocess.STDOUT})
+
     try:
         if decorate := kwargs.pop("decorate", False):
             print("-------------------- ↓ ↓ ↓ ↓ ↓ --------------------")
-        cp = subprocess.run(*args, **kwargs)
+        cp = _traced_run(*args, **kwargs)
+        if capture:
+            output = cp.stdout
+            if isinstance(output, bytes):
+                output = output.decode(errors="replace")
+            sys.stdout.write(output or "")
+            cp.stdout = None
     finally:
         if decorate:
             print("-------------------- ↑ ↑ ↑ ↑ ↑ --------------------")
@@ -108,5 +366,5 @@ def run(*args, **kwargs):
 
 
 def run_capture(*args, **kwargs):
-    cp = subprocess.run(*args, **kwargs, capture_output=True)
+    cp = _traced_run(*args, **kwargs, capture_output=True)
     return cp
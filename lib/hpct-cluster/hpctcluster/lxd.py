@@ -0,0 +1,212 @@
+#! /usr/bin/env python3
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+#
+# hpctcluster/lxd.py
+
+"""Local LXD host: capacity, and base images for juju machines.
+
+On the localhost (LXD) cloud, juju looks for a local image aliased
+"juju/<series>/<arch>" (juju 2.9) or "juju/ubuntu@<version>/<arch>"
+(juju 3) before downloading one. Copying the base image in ahead of a
+deploy (and keeping it updated) takes the download and unpack out of
+machine creation. A "baked" image (the base image with extra packages
+installed) can be published under the same aliases, so that juju
+creates machines from it instead.
+"""
+
+import json
+import time
+
+from hpctcluster.lib import run, run_capture
+
+
+LXC_EXEC = "lxc"
+IMAGE_REMOTE = "ubuntu"
+BAKE_CONTAINER_PREFIX = "hpct-bake"
+
+UBUNTU_SERIES = {
+    "focal": "20.04",
+    "jammy": "22.04",
+    "noble": "24.04",
+}
+
+
+def parse_run_on(run_on):
+    """Return (series, arch) for a charm run-on ("ubuntu-22.04-amd64")."""
+
+    try:
+        _, version, arch = run_on.split("-")
+    except ValueError:
+        raise Exception(f"bad run-on ({run_on})")
+    for series, v in UBUNTU_SERIES.items():
+        if v == version:
+            return series, arch
+    raise Exception(f"unknown ubuntu version ({version})")
+
+
+def image_aliases(series, arch):
+    """Return the aliases juju looks for."""
+
+    return [f"juju/{series}/{arch}", f"juju/ubuntu@{UBUNTU_SERIES[series]}/{arch}"]
+
+
+def baked_alias(series, arch):
+    return f"hpct/{series}/{arch}/baked"
+
+
+def get_host_capacity():
+    """Return {"cores", "mem" (MiB)} of the LXD host, or None."""
+
+    try:
+        cp = run_capture([LXC_EXEC, "query", "/1.0/resources"], text=True)
+    except:
+        # lxd not installed
+        return None
+    if cp.returncode != 0:
+        return None
+    d = json.loads(cp.stdout)
+    return {"cores": d["cpu"]["total"], "mem": d["memory"]["total"] // (1024 * 1024)}
+
+
+def get_storage_free(pool="default"):
+    """Return free space (MiB) in storage pool, or None."""
+
+    try:
+        cp = run_capture([LXC_EXEC, "query", f"/1.0/storage-pools/{pool}/resources"], text=True)
+    except:
+        # lxd not installed
+        return None
+    if cp.returncode != 0:
+        return None
+    space = json.loads(cp.stdout)["space"]
+    return (space["total"] - space["used"]) // (1024 * 1024)
+
+
+class LxdImages:
+    def __init__(self, remote=IMAGE_REMOTE):
+        self.remote = remote
+
+    def _alias_fingerprints(self):
+        """Return {alias: fingerprint} of local images."""
+
+        try:
+            cp = run_capture([LXC_EXEC, "image", "list", "local:", "--format", "json"], text=True)
+        except:
+            # lxd not installed
+            return {}
+        if cp.returncode != 0:
+            return {}
+
+        aliases = {}
+        for image in json.loads(cp.stdout):
+            for alias in image.get("aliases") or []:
+                aliases[alias["name"]] = image["fingerprint"]
+        return aliases
+
+    def _set_aliases(self, aliases, fingerprint, current):
+        for alias in aliases:
+            if current.get(alias) == fingerprint:
+                continue
+            if alias in current:
+                run_capture([LXC_EXEC, "image", "alias", "delete", f"local:{alias}"])
+            cp = run_capture([LXC_EXEC, "image", "alias", "create", f"local:{alias}", fingerprint])
+            if cp.returncode != 0:
+                return cp.returncode
+        return 0
+
+    def status(self, series, arch):
+        """Return "missing", "cached" (base image) or "baked"."""
+
+        current = self._alias_fingerprints()
+        fingerprints = set([current.get(alias) for alias in image_aliases(series, arch)])
+        if None in fingerprints:
+            return "missing"
+        if current.get(baked_alias(series, arch)) in fingerprints:
+            return "baked"
+        return "cached"
+
+    def prewarm(self, series, arch):
+        """Ensure a local image exists under the juju aliases; copy
+        (auto-updating) the base image if there is none. Return 0 on
+        success."""
+
+        aliases = image_aliases(series, arch)
+        current = self._alias_fingerprints()
+        fingerprints = [current[alias] for alias in aliases if alias in current]
+        if fingerprints:
+            # (re)point all aliases to the image juju would pick
+            return self._set_aliases(aliases, fingerprints[0], current)
+
+        print(f"copying base image ({self.remote}:{UBUNTU_SERIES[series]}/{arch}) ...")
+        alias_args = []
+        for alias in aliases:
+            alias_args.extend(["--alias", alias])
+        cp = run(
+            [
+                LXC_EXEC,
+                "image",
+                "copy",
+                f"{self.remote}:{UBUNTU_SERIES[series]}/{arch}",
+                "local:",
+                *alias_args,
+                "--auto-update",
+            ],
+            text=True,
+            decorate=True,
+        )
+        return cp.returncode
+
+    def bake(self, series, arch, packages):
+        """Build an image from the base image with packages installed
+        and publish it under the juju aliases. Return 0 on success."""
+
+        rv = self.prewarm(series, arch)
+        if rv != 0:
+            return rv
+
+        # from the (locally cached) remote image, not a previous bake
+        container = f"{BAKE_CONTAINER_PREFIX}-{series}-{arch}-{int(time.time())}"
+        base = f"{self.remote}:{UBUNTU_SERIES[series]}/{arch}"
+        print(f"baking image ({baked_alias(series, arch)}) ...")
+        try:
+            steps = [
+                [LXC_EXEC, "launch", base, container],
+                [LXC_EXEC, "exec", container, "--", "cloud-init", "status", "--wait"],
+                [LXC_EXEC, "exec", container, "--", "apt-get", "update"],
+                [
+                    LXC_EXEC,
+                    "exec",
+                    container,
+                    "--env",
+                    "DEBIAN_FRONTEND=noninteractive",
+                    "--",
+                    "apt-get",
+                    "install",
+                    "-y",
+                    *packages,
+                ],
+                [LXC_EXEC, "stop", container],
+            ]
+            for cmdargs in steps:
+                cp = run(cmdargs, text=True, decorate=True)
+                if cp.returncode != 0:
+                    return cp.returncode
+
+            current = self._alias_fingerprints()
+            if baked_alias(series, arch) in current:
+                run_capture([LXC_EXEC, "image", "alias", "delete", baked_alias(series, arch)])
+            cp = run(
+                [LXC_EXEC, "publish", container, "--alias", baked_alias(series, arch)],
+                text=True,
+                decorate=True,
+            )
+            if cp.returncode != 0:
+                return cp.returncode
+
+            current = self._alias_fingerprints()
+            return self._set_aliases(
+                image_aliases(series, arch), current[baked_alias(series, arch)], current
+            )
+        finally:
+            run_capture([LXC_EXEC, "delete", "--force", container])
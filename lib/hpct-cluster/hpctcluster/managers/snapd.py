@@ -35,10 +35,18 @@ class UbuntuSnapdManager(UbuntuManager):
     ]
 
 
-__series = get_series()
-if __series.full in ["centos-8", "centos-9", "oracle-8", "oracle-9"]:
-    SnapdManager = RedHatSnapdManager
-elif __series.full in ["ubuntu-20.04", "ubuntu-22.04"]:
-    SnapdManager = UbuntuSnapdManager
-else:
-    raise ManagerException("unsupported series")
+def __getattr__(name):
+    # SnapdManager is picked for the series on first use (not on import)
+    global SnapdManager
+
+    if name != "SnapdManager":
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    series = get_series()
+    if series.full in ["centos-8", "centos-9", "oracle-8", "oracle-9"]:
+        SnapdManager = RedHatSnapdManager
+    elif series.full in ["ubuntu-20.04", "ubuntu-22.04"]:
+        SnapdManager = UbuntuSnapdManager
+    else:
+        raise ManagerException("unsupported series")
+    return SnapdManager
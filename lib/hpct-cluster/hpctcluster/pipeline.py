@@ -0,0 +1,165 @@
+#! /usr/bin/env python3
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+#
+# hpctcluster/pipeline.py
+
+"""Dependency-aware step runner (used by setup).
+
+Steps declare the steps they require; independent steps run
+concurrently. Steps sharing a lock (e.g., the distro package manager)
+never run at the same time, and an interactive step (one that prompts)
+runs alone. A completed step leaves a marker file so that a re-run
+resumes with the incomplete steps only.
+"""
+
+import os
+import os.path
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+
+class PipelineStep:
+    def __init__(self, name, fn, requires=None, lock=None, interactive=False):
+        self.name = name
+        self.fn = fn
+        self.requires = requires or []
+        self.lock = lock
+        self.interactive = interactive
+        self.state = PENDING
+        self.start_time = None
+        self.end_time = None
+
+    def elapsed(self):
+        if self.start_time == None:
+            return None
+        return (self.end_time or time.time()) - self.start_time
+
+
+class Pipeline:
+    """Run steps in dependency order, up to `jobs` at a time.
+
+    A step fails if it raises or returns a value other than None or 0;
+    steps requiring a failed step are skipped.
+    """
+
+    def __init__(self, steps, markers_dir, jobs=4, redo=False):
+        self.steps = steps
+        self.markers_dir = markers_dir
+        self.jobs = max(1, jobs)
+        self.redo = redo
+        self._lock = threading.Lock()
+
+        names = [step.name for step in steps]
+        for step in steps:
+            for name in step.requires:
+                if name not in names:
+                    raise Exception(f"step ({step.name}) requires unknown step ({name})")
+
+    def _marker_path(self, step):
+        return f"{self.markers_dir}/{step.name}.done"
+
+    def is_done(self, step):
+        return os.path.exists(self._marker_path(step))
+
+    def _run_step(self, step):
+        step.start_time = time.time()
+        self._report(step)
+        try:
+            rv = step.fn()
+            ok = rv in [None, 0]
+        except Exception as e:
+            traceback.print_exc()
+            print(f"error: step ({step.name}) failed ({e})", file=sys.stderr)
+            ok = False
+
+        step.end_time = time.time()
+        if ok:
+            with open(self._marker_path(step), "wt") as f:
+                f.write(f"{time.strftime('%Y-%m-%dT%H:%M:%S')}\n")
+        step.state = DONE if ok else FAILED
+        self._report(step)
+        return step
+
+    def _report(self, step):
+        elapsed = step.elapsed()
+        elapsed = f" ({elapsed:.1f}s)" if elapsed != None and step.state != RUNNING else ""
+        with self._lock:
+            print(f"[{step.name}] {step.state}{elapsed}", flush=True)
+
+    def _is_ready(self, step, running):
+        states = [self._get(name).state for name in step.requires]
+        if not all([state == DONE for state in states]):
+            return False
+        if step.interactive:
+            return not running
+        if any([s.interactive for s in running]):
+            return False
+        return step.lock == None or step.lock not in [s.lock for s in running]
+
+    def _get(self, name):
+        for step in self.steps:
+            if step.name == name:
+                return step
+
+    def _skip_blocked(self):
+        changed = True
+        while changed:
+            changed = False
+            for step in self.steps:
+                if step.state != PENDING:
+                    continue
+                if any([self._get(name).state in [FAILED, SKIPPED] for name in step.requires]):
+                    step.state = SKIPPED
+                    self._report(step)
+                    changed = True
+
+    def print_summary(self):
+        print()
+        print(f"""{"step":20} {"state":8} {"time":>8}""")
+        for step in self.steps:
+            elapsed = step.elapsed()
+            elapsed = f"{elapsed:7.1f}s" if elapsed != None else ""
+            print(f"{step.name:20} {step.state:8} {elapsed:>8}")
+
+    def run(self):
+        """Run incomplete steps and return the list of failed (or
+        skipped) steps."""
+
+        os.makedirs(self.markers_dir, exist_ok=True)
+        for step in self.steps:
+            if self.redo and self.is_done(step):
+                os.remove(self._marker_path(step))
+            if self.is_done(step):
+                step.state = DONE
+                print(f"[{step.name}] already done")
+
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            while True:
+                self._skip_blocked()
+                for step in self.steps:
+                    if len(running) >= self.jobs:
+                        break
+                    if step.state == PENDING and self._is_ready(step, running.values()):
+                        step.state = RUNNING
+                        running[executor.submit(self._run_step, step)] = step
+
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    del running[future]
+                    future.result()
+
+        return [step for step in self.steps if step.state != DONE]
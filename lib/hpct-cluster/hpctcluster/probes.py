@@ -0,0 +1,89 @@
+#! /usr/bin/env python3
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+#
+# hpctcluster/probes.py
+
+"""On-disk cache of probe results (e.g., "is lxd installed?"), so that
+repeated invocations skip facts that have not changed.
+
+Each probe has its own TTL. Probe names are dotted ("lxd.installed")
+so that related probes can be invalidated together by prefix ("lxd.").
+"""
+
+import json
+import os
+import os.path
+import threading
+import time
+
+
+# by last part of probe name
+PROBE_TTLS = {
+    "installed": 3600,
+    "group": 600,
+    "images": 600,
+    "snapshot": 60,
+    "login": 30,
+}
+
+# for negative results (False/None, e.g., "not installed"), which
+# change outside of hpct-cluster (e.g., a snap installed by hand)
+NEGATIVE_TTL = 60
+
+
+def _is_negative(value):
+    return value is False or value == None
+
+
+class ProbeCache:
+    def __init__(self, path, fresh=False):
+        self.path = path
+        self.fresh = fresh
+        self._lock = threading.Lock()
+        self.entries = self._load()
+
+    def _load(self):
+        try:
+            return json.loads(open(self.path).read())
+        except:
+            return {}
+
+    def _save(self):
+        # best effort; a cache that cannot be written is just not used
+        try:
+            tmp = f"{self.path}.tmp.{os.getpid()}.{threading.get_ident()}"
+            with open(tmp, "wt") as f:
+                json.dump(self.entries, f, indent=2, sort_keys=True)
+            os.replace(tmp, self.path)
+        except:
+            pass
+
+    def get(self, name, fn, ttl):
+        """Return cached value of probe if younger than ttl (or
+        NEGATIVE_TTL, if shorter, for a negative value); otherwise (or
+        with fresh set) run fn() and cache its value."""
+
+        with self._lock:
+            entry = self.entries.get(name)
+            if not self.fresh and entry:
+                if _is_negative(entry["value"]):
+                    ttl = min(ttl, NEGATIVE_TTL)
+                if time.time() - entry["time"] < ttl:
+                    return entry["value"]
+
+        value = fn()
+        with self._lock:
+            self.entries[name] = {"time": time.time(), "value": value}
+            self._save()
+        return value
+
+    def invalidate(self, *prefixes):
+        """Drop probes whose names start with any of prefixes (all
+        probes if none given)."""
+
+        with self._lock:
+            for name in list(self.entries):
+                if not prefixes or name.startswith(prefixes):
+                    del self.entries[name]
+            self._save()
@@ -0,0 +1,191 @@
+#! /usr/bin/env python3
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+#
+# hpctcluster/trace.py
+
+"""Subprocess tracing.
+
+With HPCT_TRACE=<path>, run()/run_capture() (hpctcluster.lib) append
+one record per call to <path>: argv, cwd, start/end, exit code,
+stdout/stderr sizes and the current phase. The format is JSONL, or
+Chrome trace-event format (viewable in chrome://tracing or Perfetto)
+if the path ends in ".json" or HPCT_TRACE_FORMAT=chrome.
+"""
+
+import contextlib
+import json
+import os
+import os.path
+import threading
+
+
+_lock = threading.Lock()
+_local = threading.local()
+_default_phase = None
+
+
+def get_trace_path():
+    return os.environ.get("HPCT_TRACE")
+
+
+def get_trace_format(path):
+    fmt = os.environ.get("HPCT_TRACE_FORMAT")
+    if fmt:
+        return fmt
+    return "chrome" if path.endswith(".json") else "jsonl"
+
+
+def current_phase():
+    stack = getattr(_local, "stack", None)
+    if stack:
+        return "/".join([name for name, _ in stack])
+    return _default_phase
+
+
+class phase(contextlib.ContextDecorator):
+    """Name the phase (e.g., a Control method) that subprocesses are
+    run for. Usable as a context manager or decorator; phases nest.
+    Threads without a phase of their own use the outermost phase of
+    the thread that started one first."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        global _default_phase
+
+        if not hasattr(_local, "stack"):
+            _local.stack = []
+        is_default = _default_phase == None
+        if is_default:
+            _default_phase = self.name
+        _local.stack.append((self.name, is_default))
+        return self
+
+    def __exit__(self, *exc):
+        global _default_phase
+
+        _, is_default = _local.stack.pop()
+        if is_default:
+            _default_phase = None
+        return False
+
+
+def inherit_phase(fn):
+    """Wrap fn to run (e.g., in a worker thread) in the phase of the
+    calling thread."""
+
+    stack = [(name, False) for name, _ in getattr(_local, "stack", [])]
+
+    def wrapper(*args, **kwargs):
+        previous = getattr(_local, "stack", None)
+        _local.stack = list(stack)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            if previous == None:
+                del _local.stack
+            else:
+                _local.stack = previous
+
+    return wrapper
+
+
+def _output_size(v):
+    return len(v) if isinstance(v, (str, bytes)) else None
+
+
+def record(argv, cwd, start_time, end_time, cp=None, error=None):
+    """Write trace record (if tracing is enabled)."""
+
+    path = get_trace_path()
+    if not path:
+        return
+
+    argv = [str(arg) for arg in ([argv] if isinstance(argv, (str, bytes)) else argv)]
+    rec = {
+        "argv": argv,
+        "cwd": cwd or os.getcwd(),
+        "start": start_time,
+        "end": end_time,
+        "duration": end_time - start_time,
+        "returncode": cp.returncode if cp != None else None,
+        "stdout_size": _output_size(cp.stdout) if cp != None else None,
+        "stderr_size": _output_size(cp.stderr) if cp != None else None,
+        "phase": current_phase(),
+        "pid": os.getpid(),
+        "tid": threading.get_ident(),
+    }
+    if error:
+        rec["error"] = error
+
+    with _lock:
+        with open(path, "a") as f:
+            if get_trace_format(path) == "chrome":
+                # JSON array format; the closing "]" is optional
+                if f.tell() == 0:
+                    f.write("[\n")
+                event = {
+                    "name": command_key(argv),
+                    "cat": rec["phase"] or "-",
+                    "ph": "X",
+                    "ts": int(start_time * 1e6),
+                    "dur": int((end_time - start_time) * 1e6),
+                    "pid": rec["pid"],
+                    "tid": rec["tid"],
+                    "args": rec,
+                }
+                f.write(json.dumps(event) + ",\n")
+            else:
+                f.write(json.dumps(rec) + "\n")
+
+
+def command_key(argv):
+    """Return short name for a command (program and subcommand)."""
+
+    words = [os.path.basename(argv[0])] if argv else []
+    for arg in argv[1:]:
+        if not arg.startswith("-"):
+            words.append(arg)
+            break
+    return " ".join(words)
+
+
+def load_records(path):
+    text = open(path).read()
+    if text.lstrip().startswith("["):
+        text = text.strip().rstrip(",")
+        if not text.endswith("]"):
+            text += "]"
+        return [event["args"] for event in json.loads(text) if "args" in event]
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def report(path, count=10):
+    """Print slowest and most repeated commands, per phase."""
+
+    records = load_records(path)
+    phases = {}
+    for rec in records:
+        phases.setdefault(rec.get("phase") or "-", []).append(rec)
+
+    print(f"trace: {path}")
+    print(f"""records: {len(records)} total time: {sum([r["duration"] for r in records]):.2f}s""")
+    for name in sorted(phases):
+        recs = phases[name]
+        print()
+        print(f"""PHASE: {name} ({len(recs)} calls, {sum([r["duration"] for r in recs]):.2f}s)""")
+
+        print("slowest:")
+        for rec in sorted(recs, key=lambda r: r["duration"], reverse=True)[:count]:
+            cmd = " ".join(rec["argv"])
+            print(f"""  {rec["duration"]:8.3f}s  rc={rec["returncode"]}  {cmd}""")
+
+        print("most repeated:")
+        groups = {}
+        for rec in recs:
+            groups.setdefault(command_key(rec["argv"]), []).append(rec["duration"])
+        groups = sorted(groups.items(), key=lambda kv: (-len(kv[1]), -sum(kv[1])))
+        for key, durations in groups[:count]:
+            print(f"  {len(durations):5}x  {sum(durations):8.3f}s  {key}")
@@ -0,0 +1,249 @@
+#! /usr/bin/env python3
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+#
+# hpctcluster/users.py
+
+"""Bulk user import.
+
+Users come from a CSV file (header line with columns name, group, uid,
+gid, gecos; name is required), an LDIF file (entries with a uid) or
+the interview results (user.name.<n>, user.group.<n>). All users are
+validated before any is sent. They are then sent to the ldap server
+application in batches, one action per batch, with the batch as a JSON
+list of user objects in the "users" parameter. Batches are sent one at
+a time: actions go to the leader unit, and juju runs the actions of a
+unit one after the other anyway.
+
+Completed batches are recorded in a state file, so that an interrupted
+(or partly failed) import resumes with the batches not yet done.
+"""
+
+import base64
+import csv
+import hashlib
+import json
+import os
+import re
+import time
+
+
+DEFAULT_APPLICATION = "ldap-server"
+DEFAULT_ACTION = "add-users"
+DEFAULT_BATCH_SIZE = 500
+MAX_ERRORS_SHOWN = 20
+
+FIELDS = ["name", "group", "uid", "gid", "gecos"]
+LDIF_ATTRS = {"uid": "name", "uidNumber": "uid", "gidNumber": "gid", "cn": "gecos"}
+NAME_RE = re.compile(r"^[a-z_][a-z0-9_-]{0,31}$")
+
+
+def load_csv(path):
+    """Yield (location, user) from CSV file."""
+
+    with open(path, newline="") as f:
+        reader = csv.DictReader(f)
+        unknown = [k for k in reader.fieldnames or [] if k.strip() not in FIELDS]
+        if unknown:
+            raise Exception(f"""unknown columns ({", ".join(unknown)})""")
+        for row in reader:
+            user = {k.strip(): v.strip() for k, v in row.items() if k != None and v}
+            if row.get(None):
+                user["_error"] = "too many fields"
+            yield f"line {reader.line_num}", user
+
+
+def _ldif_entries(f):
+    """Yield (line number, lines) per entry, with continuation lines
+    joined and comments dropped."""
+
+    lines = []
+    start = None
+    for lineno, line in enumerate(f, 1):
+        line = line.rstrip("\r\n")
+        if not line:
+            if lines:
+                yield start, lines
+            lines = []
+        elif line.startswith("#"):
+            continue
+        elif line.startswith(" ") and lines:
+            lines[-1] += line[1:]
+        else:
+            if not lines:
+                start = lineno
+            lines.append(line)
+    if lines:
+        yield start, lines
+
+
+def load_ldif(path):
+    """Yield (location, user) for entries (of LDIF file) with a uid."""
+
+    with open(path) as f:
+        for lineno, lines in _ldif_entries(f):
+            attrs = {}
+            for line in lines:
+                attr, _, value = line.partition(":")
+                if value.startswith(":"):
+                    value = base64.b64decode(value[1:].strip()).decode()
+                attrs.setdefault(attr.strip(), value.strip())
+            if "uid" in attrs:
+                yield f"line {lineno}", {
+                    field: attrs[attr] for attr, field in LDIF_ATTRS.items() if attr in attrs
+                }
+
+
+def load_interview(results):
+    """Yield (location, user) from interview results."""
+
+    d = results.get("user") or {}
+    names = d.get("name") or {}
+    groups = d.get("group") or {}
+    for i in range(int(d.get("count") or 0)):
+        user = {"name": names.get(str(i), names.get(i))}
+        group = groups.get(str(i), groups.get(i))
+        if group:
+            user["group"] = group
+        yield f"user {i}", user
+
+
+def load_users(path=None, results=None):
+    """Yield (location, user) from file (LDIF if it ends in ".ldif",
+    otherwise CSV) or, without path, interview results."""
+
+    if path == None:
+        return load_interview(results or {})
+    if path.endswith(".ldif"):
+        return load_ldif(path)
+    return load_csv(path)
+
+
+def validate_user(user):
+    """Return error message for user, or None if valid."""
+
+    if user.get("_error"):
+        return user["_error"]
+    name = user.get("name")
+    if not name:
+        return "missing name"
+    if not NAME_RE.match(str(name)):
+        return f"bad name ({name})"
+    if user.get("group") and not NAME_RE.match(str(user["group"])):
+        return f"""bad group ({user["group"]})"""
+    for k in ["uid", "gid"]:
+        if user.get(k) and not str(user[k]).isdigit():
+            return f"bad {k} ({user[k]})"
+    return None
+
+
+def validate_users(records):
+    """Return (users, errors) from (location, user) records. Errors are
+    (location, message); duplicate names are errors."""
+
+    users = []
+    errors = []
+    names = set()
+    for location, user in records:
+        error = validate_user(user)
+        if error == None and user["name"] in names:
+            error = f"""duplicate name ({user["name"]})"""
+        if error:
+            errors.append((location, error))
+            continue
+        names.add(user["name"])
+        users.append(user)
+    return users, errors
+
+
+class UserImport:
+    """Send users to the ldap server application in batches, one at a
+    time, keeping progress in state_path."""
+
+    def __init__(
+        self,
+        juju,
+        state_path,
+        application=DEFAULT_APPLICATION,
+        action=DEFAULT_ACTION,
+        batch_size=DEFAULT_BATCH_SIZE,
+    ):
+        self.juju = juju
+        self.state_path = state_path
+        self.application = application
+        self.action = action
+        self.batch_size = max(1, batch_size)
+        self.state = None
+
+    def _fingerprint(self, users):
+        h = hashlib.sha256()
+        h.update(json.dumps([self.application, self.action, self.batch_size]).encode())
+        h.update(json.dumps(users, sort_keys=True).encode())
+        return h.hexdigest()
+
+    def _load_state(self, fingerprint, restart):
+        state = None
+        if not restart:
+            try:
+                state = json.loads(open(self.state_path).read())
+            except:
+                pass
+        if state and state.get("fingerprint") != fingerprint:
+            print("users (or batch settings) changed since the last import; starting over")
+            state = None
+        return state or {"fingerprint": fingerprint, "done": []}
+
+    def _save_state(self):
+        tmp = f"{self.state_path}.tmp.{os.getpid()}"
+        with open(tmp, "wt") as f:
+            json.dump(self.state, f)
+        os.replace(tmp, self.state_path)
+
+    def _run_batch(self, index, batch, nbatches):
+        start_time = time.time()
+        rv, results = self.juju.run_action(
+            f"{self.application}/leader", self.action, {"users": json.dumps(batch)}
+        )
+        elapsed = time.time() - start_time
+
+        if rv == 0:
+            self.state["done"].append(index)
+            self._save_state()
+            state = f"ok ({elapsed:.1f}s, {len(batch) / max(elapsed, 1e-6):.0f} users/s)"
+        else:
+            state = f"""failed ({results.get("message") or results or "-"})"""
+        print(f"[batch {index + 1}/{nbatches}] {len(batch)} users: {state}", flush=True)
+        return rv
+
+    def run(self, users, restart=False):
+        """Import users (not already imported) and return the list of
+        failed batches (indexes)."""
+
+        batches = [users[i : i + self.batch_size] for i in range(0, len(users), self.batch_size)]
+        self.state = self._load_state(self._fingerprint(users), restart)
+        done = set(self.state["done"])
+        todo = [index for index in range(len(batches)) if index not in done]
+        nskipped = sum([len(batches[index]) for index in done if index < len(batches)])
+        if done:
+            print(f"already imported: {nskipped} users ({len(done)} batches)")
+
+        start_time = time.time()
+        failed = []
+        for index in todo:
+            try:
+                rv = self._run_batch(index, batches[index], len(batches))
+            except Exception as e:
+                print(f"[batch {index + 1}/{len(batches)}] failed ({e})")
+                rv = 1
+            if rv != 0:
+                failed.append(index)
+
+        elapsed = time.time() - start_time
+        nimported = len(users) - nskipped - sum([len(batches[index]) for index in failed])
+        print(
+            f"imported: {nimported} users in {len(batches) - len(done) - len(failed)} batches"
+            f" ({elapsed:.1f}s, {nimported / max(elapsed, 1e-6):.0f} users/s)"
+        )
+        if failed:
+            print(f"failed: {len(failed)} batches (re-run to retry)")
+        return sorted(failed)
@@ -0,0 +1,228 @@
+#! /usr/bin/env python3
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+#
+# hpctcluster/watch.py
+
+"""Follow model status changes.
+
+Status snapshots (in "juju status --format json" form) come from
+Juju.watch() or Juju.status(); changes are found by comparing
+flattened snapshots.
+"""
+
+import sys
+import time
+
+
+MONITOR_MIN_INTERVAL = 2
+MONITOR_MAX_INTERVAL = 60
+MONITOR_HISTORY = 20
+
+
+def flatten_units(status):
+    """Return {unit: (application, workload, agent, machine)},
+    including subordinate units."""
+
+    units = {}
+
+    def walk(d, machine=None):
+        for name, unit in (d or {}).items():
+            units[name] = (
+                name.split("/")[0],
+                (unit.get("workload-status") or {}).get("current"),
+                (unit.get("juju-status") or {}).get("current"),
+                unit.get("machine", machine),
+            )
+            walk(unit.get("subordinates"), unit.get("machine", machine))
+
+    for app in ((status or {}).get("applications") or {}).values():
+        walk(app.get("units"))
+    return units
+
+
+def flatten_machines(status):
+    """Return {machine: (agent, instance)}."""
+
+    return {
+        name: (
+            (machine.get("juju-status") or {}).get("current"),
+            (machine.get("machine-status") or {}).get("current"),
+        )
+        for name, machine in ((status or {}).get("machines") or {}).items()
+    }
+
+
+def flatten_relations(status):
+    """Return set of "app:endpoint remote-app" strings."""
+
+    relations = set()
+    for appname, app in ((status or {}).get("applications") or {}).items():
+        for endpoint, remotes in (app.get("relations") or {}).items():
+            for remote in remotes:
+                relations.add(f"{appname}:{endpoint} {remote}")
+    return relations
+
+
+def diff_status(old, new):
+    """Return list of changes (strings) between two snapshots."""
+
+    changes = []
+    for kind, flatten in [("unit", flatten_units), ("machine", flatten_machines)]:
+        old_items = flatten(old)
+        new_items = flatten(new)
+        for name in sorted(set(old_items) | set(new_items)):
+            o, n = old_items.get(name), new_items.get(name)
+            if o == None:
+                changes.append(f"{kind} {name}: added ({_format_state(kind, n)})")
+            elif n == None:
+                changes.append(f"{kind} {name}: removed")
+            elif o != n:
+                changes.append(
+                    f"{kind} {name}: {_format_state(kind, o)} -> {_format_state(kind, n)}"
+                )
+
+    old_relations = flatten_relations(old)
+    new_relations = flatten_relations(new)
+    for relation in sorted(new_relations - old_relations):
+        changes.append(f"relation {relation}: added")
+    for relation in sorted(old_relations - new_relations):
+        changes.append(f"relation {relation}: removed")
+    return changes
+
+
+def _format_state(kind, state):
+    if kind == "unit":
+        return f"{state[1]}/{state[2]} machine {state[3]}"
+    return "/".join([str(v) for v in state])
+
+
+def is_application_active(units, appname):
+    states = [(w, a) for app, w, a, _ in units.values() if app == appname]
+    return bool(states) and all([state == ("active", "idle") for state in states])
+
+
+class DeployTracker:
+    """Report per-unit state changes until all applications are
+    active/idle."""
+
+    def __init__(self, appnames):
+        self.appnames = appnames
+        self.start_time = time.time()
+        self.active_times = {}
+        self.units = {}
+
+    def update(self, status):
+        """Print unit changes and return True once every application
+        is active/idle."""
+
+        units = flatten_units(status)
+        elapsed = time.time() - self.start_time
+
+        for name in sorted(units):
+            old = self.units.get(name)
+            new = units[name]
+            if old == None:
+                print(f"[{elapsed:7.1f}s] {name}: added ({new[1]}/{new[2]})")
+            elif old[1:3] != new[1:3]:
+                print(f"[{elapsed:7.1f}s] {name}: {old[1]}/{old[2]} -> {new[1]}/{new[2]}")
+        for name in sorted(set(self.units) - set(units)):
+            print(f"[{elapsed:7.1f}s] {name}: removed")
+        self.units = units
+
+        for appname in self.appnames:
+            if is_application_active(units, appname):
+                self.active_times.setdefault(appname, elapsed)
+            else:
+                self.active_times.pop(appname, None)
+
+        return len(self.active_times) == len(self.appnames)
+
+    def print_summary(self):
+        print()
+        print(f"""{"application":40} {"time to active":>14}""")
+        for appname in self.appnames:
+            t = self.active_times.get(appname)
+            print(f"""{appname:40} {f"{t:.1f}s" if t != None else "not active":>14}""")
+
+    def run(self, snapshots, timeout=None):
+        """Consume snapshots until done (True) or timed out (False)."""
+
+        for status in snapshots:
+            if status != None and self.update(status):
+                return True
+            if timeout != None and time.time() - self.start_time > timeout:
+                return False
+        return False
+
+
+class StatusMonitor:
+    """Monitor model status in the current terminal, showing only
+    what changed since the last snapshot.
+
+    The poll interval doubles (up to a maximum) while nothing changes,
+    and drops back to the minimum on any change.
+    """
+
+    def __init__(self, juju, tui=False):
+        self.juju = juju
+        self.tui = tui and sys.stdout.isatty()
+        self.interval = MONITOR_MIN_INTERVAL
+        self.history = []
+        self.status = None
+
+    def _draw(self, status):
+        units = flatten_units(status)
+        counts = {}
+        for _, workload, _, _ in units.values():
+            counts[workload] = counts.get(workload, 0) + 1
+        summary = ", ".join([f"{k} {v}" for k, v in sorted(counts.items(), key=str)])
+
+        sys.stdout.write("\033[H\033[2J")
+        print(f"""model: {self.juju.model}  updated: {time.strftime("%H:%M:%S")}""")
+        print(f"next poll: {self.interval}s")
+        print(
+            f"units: {len(units)} ({summary})"
+            f"  machines: {len(flatten_machines(status))}"
+            f"  relations: {len(flatten_relations(status))}"
+        )
+        print()
+        print("recent changes:")
+        for line in self.history[-MONITOR_HISTORY:]:
+            print(line)
+        sys.stdout.flush()
+
+    def poll(self):
+        """Take one snapshot and return the changes since the last
+        one."""
+
+        status = self.juju.status(timeout=max(self.interval, 30))
+        if status == None:
+            return None
+
+        changes = diff_status(self.status, status)
+        self.status = status
+
+        stamp = time.strftime("%H:%M:%S")
+        lines = [f"[{stamp}] {change}" for change in changes]
+        self.history = (self.history + lines)[-MONITOR_HISTORY:]
+        if changes:
+            self.interval = MONITOR_MIN_INTERVAL
+        else:
+            self.interval = min(self.interval * 2, MONITOR_MAX_INTERVAL)
+
+        if self.tui:
+            self._draw(status)
+        else:
+            for line in lines:
+                print(line, flush=True)
+        return changes
+
+    def run(self):
+        try:
+            while True:
+                if self.poll() == None:
+                    print(f"""[{time.strftime("%H:%M:%S")}] warning: cannot get status""")
+                time.sleep(self.interval)
+        except KeyboardInterrupt:
+            print()